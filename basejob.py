@@ -0,0 +1,33 @@
+import logging
+from threading import Event
+
+from telegram.ext import Job
+
+from models import db
+
+
+class DatabaseJob(Job):
+    """
+    Repeating job of the bot, whose `run_job(bot)` gets a connection of the
+    database pool on each run.
+    """
+
+    def __init__(self, context=None, interval=None):
+        # jobs whose interval changes between runs compute it in a property
+        if interval is not None:
+            self.interval = interval
+        self.repeat = True
+        self.context = context
+        self.name = self.__class__.__name__
+        self._remove = Event()
+        self._enabled = Event()
+        self._enabled.set()
+        self.logger = logging.getLogger(self.name)
+
+    def run(self, bot):
+        # hand pooled connections back between runs
+        with db.connection_context():
+            self.run_job(bot)
+
+    def run_job(self, bot):
+        raise NotImplementedError
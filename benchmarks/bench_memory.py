@@ -0,0 +1,88 @@
+"""
+Peak Python memory of a FetchAndSendTweetsJob run as the number of accounts
+and chats grows. The job reads, polls and commits the users in chunks, so
+its peak should stay flat: this exits with an error when the largest
+dataset's peak is more than --max-growth times the smallest one's, or above
+--max-peak-mib.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_memory --users 2000 20000 --max-peak-mib 8
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fakes import FakeSenderBot, FakeTwitterAPI
+from benchmarks.loadtest import build_dataset
+
+
+def measure(users, args):
+    """Peak MiB and seconds of one job run over `users` accounts, and how many it polled"""
+    import models
+    from job import FetchAndSendTweetsJob
+    from ratelimit import RateLimitBudget
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='bench-memory-'), 'memory.db')
+    models.init_database('sqlite:///' + db_path)
+    models.migrate_schema()
+
+    api = FakeTwitterAPI(tweet_rate=args.tweet_rate, rate_limit=10 ** 9, seed=args.seed)
+    bot = FakeSenderBot(api)
+    dataset = argparse.Namespace(users=users, chats=users, tweets=users * 2,
+                                 subscriptions=users * args.subscriptions_per_user)
+    build_dataset(dataset, api, random.Random(args.seed))
+    models.db.close()
+
+    job = FetchAndSendTweetsJob()
+    # poll every account in the one run
+    job.timeline_budget = RateLimitBudget(api.rate_limit, api.rate_window)
+    calls = api.calls
+    tracemalloc.start()
+    start = time.perf_counter()
+    job.run(bot)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    os.remove(db_path)
+    return peak / 2 ** 20, elapsed, api.calls - calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[2000, 20000])
+    parser.add_argument('--subscriptions-per-user', type=int, default=5)
+    parser.add_argument('--tweet-rate', type=float, default=0.001,
+                        help="tweets per second per account")
+    parser.add_argument('--max-growth', type=float, default=2.0,
+                        help="largest allowed ratio of the peaks of the largest and smallest runs")
+    parser.add_argument('--max-peak-mib', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>10} {:>9} {:>10}".format(
+        'users', 'subscriptions', 'api calls', 'run s', 'peak MiB'))
+    peaks = []
+    for users in sorted(args.users):
+        peak, elapsed, calls = measure(users, args)
+        peaks.append(peak)
+        print("{:>8} {:>14} {:>10} {:>9.2f} {:>10.2f}".format(
+            users, users * args.subscriptions_per_user, calls, elapsed, peak))
+
+    failures = []
+    if len(peaks) > 1 and peaks[-1] > peaks[0] * args.max_growth:
+        failures.append("peak grew {:.1f}x from {} to {} users, more than {}x".format(
+            peaks[-1] / peaks[0], min(args.users), max(args.users), args.max_growth))
+    if args.max_peak_mib is not None and max(peaks) > args.max_peak_mib:
+        failures.append("peak of {:.2f} MiB above {} MiB".format(max(peaks), args.max_peak_mib))
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
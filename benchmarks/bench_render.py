@@ -0,0 +1,103 @@
+"""
+Compare the single pass tweet renderer (util.prepare_tweet_text) with the
+former escape_markdown + markdown_twitter_usernames + markdown_twitter_hashtags
+regex pipeline: checks both give the same output on a corpus of tweets, then times
+them.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_render [--tweets N] [--repeat N]
+"""
+import argparse
+import random
+import re
+import sys
+import timeit
+
+from util import prepare_tweet_text
+
+# Corner cases where the output has to match the old pipeline exactly
+GOLDEN_CORPUS = [
+    '',
+    'plain text with no markup',
+    'hello @some_user how are you?',
+    '@user_with_underscores_ and @UPPER123',
+    '#hashtag #another_one #',
+    '#tag@mention in the middle',
+    '@mention#tag glued together',
+    'markdown *bold* _italic_ `code` [link](http://x)',
+    '@name* right before a symbol, @name[ and @name`',
+    '@ alone, @* and @_ and @\\ too',
+    'escaped \\_ backslash \\ @back\\slash #back\\_slash',
+    'https://example.com/#anchor and https://example.com/a_b_c',
+    'RT @someone: thread 1/3 #news_today https://t.co/abc_def',
+    'unicode @ñandú #café 🐦 *',
+    'tabs\tand\nnew lines #x\n@y',
+]
+
+WORDS = ['the', 'news', 'today', 'breaking', 'thread', 'photo', 'via', 'lol', 'more',
+         'is', 'a', 'on', 'for', '2020', 'live', 'update', 'great', 'snake_case']
+
+
+def legacy_prepare_tweet_text(text):
+    """prepare_tweet_text as it was before the single pass renderer"""
+    res = re.sub(r'([\*_`\[])', r'\\\1', text)
+    res = re.sub(r'@([A-Za-z0-9_\\]+)',
+                 lambda s: '[@{username}](https://twitter.com/{username})'
+                 .format(username=s.group(1).replace(r'\_', '_')),
+                 res)
+    res = re.sub(r'#([^\s]*)',
+                 lambda s: '[#{tag}](https://twitter.com/hashtag/{tag})'
+                 .format(tag=s.group(1).replace(r'\_', '_')),
+                 res)
+    return res
+
+
+def random_tweet(rng):
+    tokens = []
+    for _ in range(rng.randint(5, 40)):
+        kind = rng.random()
+        if kind < 0.1:
+            tokens.append('@' + rng.choice(WORDS) + '_' + rng.choice(WORDS))
+        elif kind < 0.18:
+            tokens.append('#' + rng.choice(WORDS).capitalize())
+        elif kind < 0.22:
+            tokens.append('https://example.com/' + rng.choice(WORDS) + '_' +
+                          str(rng.randint(1, 999)))
+        elif kind < 0.25:
+            tokens.append(rng.choice('*_`[') + rng.choice(WORDS))
+        else:
+            tokens.append(rng.choice(WORDS))
+    return ' '.join(tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tweets', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = GOLDEN_CORPUS + [random_tweet(rng) for _ in range(args.tweets)]
+
+    mismatches = [text for text in corpus
+                  if prepare_tweet_text(text) != legacy_prepare_tweet_text(text)]
+    for text in mismatches[:10]:
+        print("MISMATCH: {!r}".format(text))
+        print("  legacy:      {!r}".format(legacy_prepare_tweet_text(text)))
+        print("  single pass: {!r}".format(prepare_tweet_text(text)))
+    if mismatches:
+        print("{} of {} tweets rendered differently".format(len(mismatches), len(corpus)))
+        sys.exit(1)
+    print("Output identical on {} tweets".format(len(corpus)))
+
+    for name, render in (('legacy', legacy_prepare_tweet_text),
+                         ('single pass', prepare_tweet_text)):
+        seconds = min(timeit.repeat(lambda: [render(text) for text in corpus],
+                                    number=1, repeat=args.repeat))
+        print("{:>12}: {:8.2f} us/tweet".format(name, seconds / len(corpus) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
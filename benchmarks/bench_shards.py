@@ -0,0 +1,174 @@
+"""
+Sharded fetch workers on a shared database, a temporary SQLite file in WAL
+mode by default: each worker process leases a share of the shards and
+fetches only their users. One worker is killed halfway through, and the
+others take its shards over once its leases expire.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_shards --workers 3 --users 2000 --seconds 30
+
+--database runs it on an empty database instead, e.g.
+postgres://user@localhost/dbname.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import tempfile
+import time
+from collections import defaultdict
+
+
+def run_worker(index, db_url, args, log, stop):
+    import models
+    models.init_database(db_url)
+    from benchmarks.fakes import FakeSenderBot, FakeTwitterAPI
+    from job import FetchAndSendTweetsJob
+    from ratelimit import RateLimitBudget
+    from shards import ShardLeases
+
+    api = FakeTwitterAPI(tweet_rate=args.tweet_rate, rate_limit=10 ** 9, seed=index)
+    # tweet ids of different workers' fake timelines must not collide
+    api._next_tweet_id = 10 ** 15 + index * 10 ** 12
+    for i in range(args.users):
+        api.add_user('user{}'.format(i))
+    bot = FakeSenderBot(api)
+
+    shard_leases = ShardLeases(args.shards, worker_name='worker{}'.format(index))
+    shard_leases.HEARTBEAT_INTERVAL = args.heartbeat
+    shard_leases.LEASE_TTL = args.lease_ttl
+    shard_leases.start()
+    job = FetchAndSendTweetsJob(shard_leases=shard_leases)
+    job.timeline_budget = RateLimitBudget(api.rate_limit, api.rate_window)
+
+    polled = []
+    fetch_timeline = job.fetch_timeline
+
+    def logged_fetch_timeline(bot, tw_user):
+        polled.append(tw_user.screen_name)
+        return fetch_timeline(bot, tw_user)
+
+    job.fetch_timeline = logged_fetch_timeline
+    while not stop.is_set():
+        job.run(bot)
+        log.put((index, time.time(), polled))
+        polled = []
+        time.sleep(args.interval)
+    shard_leases.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--shards', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--tweet-rate', type=float, default=0.01,
+                        help="tweets per second per account")
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help="seconds between job runs")
+    parser.add_argument('--heartbeat', type=float, default=1)
+    parser.add_argument('--lease-ttl', type=float, default=3)
+    parser.add_argument('--database', help="peewee URL of an empty database to use")
+    args = parser.parse_args()
+
+    db_path = None
+    db_url = args.database
+    if db_url is None:
+        tmp = tempfile.mkdtemp(prefix='bench-shards-')
+        db_path = os.path.join(tmp, 'shards.db')
+        db_url = 'sqlite:///' + db_path
+
+    import models
+    from models import FetchShard, TelegramChat, TwitterUser, Subscription, Tweet, db
+    models.init_database(db_url)
+    models.migrate_schema()
+    with db.atomic():
+        chat = TelegramChat.create(chat_id=1, tg_type='private')
+        TwitterUser.insert_many([{'screen_name': 'user{}'.format(i), 'name': 'User {}'.format(i)}
+                                 for i in range(args.users)]).execute()
+        Subscription.insert_many([{'tg_chat': chat.id, 'tw_user': tw_user_id}
+                                  for tw_user_id, in TwitterUser.select(TwitterUser.id).tuples()]
+                                 ).execute()
+    db.close()
+
+    ctx = multiprocessing.get_context('spawn')
+    # one log per worker: killing a worker while it writes to a shared queue would block the others
+    logs = [ctx.Queue() for _ in range(args.workers)]
+    stop = ctx.Event()
+    workers = [ctx.Process(target=run_worker, args=(i, db_url, args, logs[i], stop))
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    def owners():
+        with db.connection_context():
+            counts = defaultdict(int)
+            for owner, in FetchShard.select(FetchShard.owner).tuples():
+                counts[owner] += 1
+            return dict(counts)
+
+    polls = defaultdict(list)  # screen_name -> [(time, worker)]
+
+    def drain(timeout):
+        time.sleep(timeout)
+        for log in logs:
+            while True:
+                try:
+                    index, at, polled = log.get_nowait()
+                except queue.Empty:
+                    break
+                for screen_name in polled:
+                    polls[screen_name].append((at, index))
+
+    start = time.time()
+    killed_at = takeover_at = None
+    while time.time() - start < args.seconds:
+        # read the logs as they come, what the killed worker didn't write out yet is lost
+        drain(0.1)
+        if killed_at is None and time.time() - start >= args.seconds / 2:
+            print("shards before the kill: {}".format(sorted(owners().items(), key=str)))
+            workers[0].kill()
+            killed_at = time.time()
+        if killed_at is not None and takeover_at is None:
+            current = owners()
+            if 'worker0' not in current and None not in current:
+                takeover_at = time.time()
+                print("shards after the takeover: {}".format(sorted(current.items(), key=str)))
+    stop.set()
+
+    # the workers only exit once the parent has read everything they logged
+    while any(worker.is_alive() for worker in workers[1:]) or \
+            not all(log.empty() for log in logs):
+        drain(0.1)
+
+    # the workers only fill the outbox, send it from here like the bot process would
+    from benchmarks.fakes import FakeSenderBot, FakeTwitterAPI
+    from delivery import DeliveryJob
+    bot = FakeSenderBot(FakeTwitterAPI())
+    delivery_job = DeliveryJob()
+    with db.connection_context():
+        stored = Tweet.select().count()
+        while delivery_job.deliver(bot):
+            delivery_job.acknowledge()
+        delivery_job.acknowledge()
+    # a user polled by another worker right after a poll was fetched twice in the same round
+    doubled = 0
+    max_gap = 0
+    for p in polls.values():
+        p.sort()
+        for (a, worker_a), (b, worker_b) in zip(p, p[1:]):
+            doubled += worker_a != worker_b and b - a < args.interval
+            max_gap = max(max_gap, b - a)
+    print("takeover {}".format("after {:.1f}s".format(takeover_at - killed_at)
+                               if takeover_at else "didn't happen"))
+    print("users polled: {} of {}, polled twice in a round: {}, longest gap between polls: "
+          "{:.1f}s".format(len(polls), args.users, doubled, max_gap))
+    print("tweets stored: {}, messages sent from the outbox: {}".format(stored, bot.sent))
+    if db_path is not None:
+        os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
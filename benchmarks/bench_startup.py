@@ -0,0 +1,59 @@
+"""
+Measure how long the bot takes to come up: importing the models, and running
+main.py --migrate-only against a fresh database and an up to date one (the
+path taken on every restart, e.g. from examples/cron-run.sh or docker-compose's
+restart: always).
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup [--repeat N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_run(args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, env=env, check=True,
+                   stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   TELEGRAM_BOT_TOKEN='123:bench',
+                   TWITTER_CONSUMER_KEY='bench',
+                   TWITTER_CONSUMER_SECRET='bench')
+        baseline = min(timed_run(['-c', 'pass'], env) for _ in range(args.repeat))
+        results = [('interpreter', baseline)]
+
+        results.append(('import models', min(
+            timed_run(['-c', 'import models'], env) for _ in range(args.repeat))))
+
+        fresh = []
+        for i in range(args.repeat):
+            env['DATABASE_URL'] = 'sqlite:///{}'.format(os.path.join(tmp, 'fresh{}.db'.format(i)))
+            fresh.append(timed_run(['main.py', '--migrate-only'], env))
+        results.append(('migrate fresh db', min(fresh)))
+
+        results.append(('migrate up to date db', min(
+            timed_run(['main.py', '--migrate-only'], env) for _ in range(args.repeat))))
+
+    for name, seconds in results:
+        print("{:>22}: {:7.1f} ms ({:+.1f} ms over the interpreter)".format(
+            name, seconds * 1000, (seconds - baseline) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Streaming ingestion against the fake stream server: delivery latency from a
+tweet being posted to it being sent, and whether polling fills the gap left
+by a dropped connection, i.e. whether every posted tweet gets sent once.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_stream --users 200 --seconds 30 --rate-limit 3000
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from benchmarks.fakes import FakeAuth, FakeSenderBot, FakeStreamServer, FakeTwitterAPI
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--tweet-rate', type=float, default=0.02,
+                        help="tweets per second per account")
+    parser.add_argument('--interval', type=float, default=1,
+                        help="seconds between job runs")
+    parser.add_argument('--outage', type=float, default=5,
+                        help="seconds the stream is down halfway through")
+    parser.add_argument('--rate-limit', type=int, default=10 ** 9,
+                        help="user_timeline calls per 15 minutes, which pace the catch-up polls")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bench-stream-')
+    db_path = os.path.join(tmp, 'stream.db')
+
+    import models
+    from models import TwitterUser, TelegramChat, Subscription, Tweet, db
+    models.init_database('sqlite:///' + db_path)
+    models.migrate_schema()
+    from delivery import DeliveryJob
+    from job import FetchAndSendTweetsJob
+    from stream import TweetStream
+
+    api = FakeTwitterAPI(tweet_rate=args.tweet_rate, rate_limit=args.rate_limit)
+    bot = FakeSenderBot(api)
+    with db.atomic():
+        chat = TelegramChat.create(chat_id=1, tg_type='private')
+        for i in range(args.users):
+            api.add_user('user{}'.format(i))
+        bot.subscribe(chat, ['user{}'.format(i) for i in range(args.users)])
+        # from the start, rather than the latest tweet only, so every posted tweet has to be sent
+        TwitterUser.update(last_tweet_id=1).execute()
+        Subscription.update(last_tweet_id=1).execute()
+
+    server = FakeStreamServer(api)
+    server.start()
+    tweet_stream = TweetStream(FakeAuth())
+    tweet_stream.stream_class = server.stream_class
+    tweet_stream.BACKOFF_START = 1
+    tweet_stream.start()
+
+    latencies = []
+    # of the tweets posted while the polls catch up after the outage
+    catch_up_latencies = []
+    back_at = []
+    delivered = Counter()
+    send_tweets = bot.send_tweets
+
+    def timed_send_tweets(chat, tweets, **kwargs):
+        send_tweets(chat, tweets, **kwargs)
+        now = datetime.utcnow()
+        for tweet in tweets:
+            latency = (now - tweet.created_at).total_seconds()
+            latencies.append(latency)
+            if back_at and tweet.created_at >= back_at[0]:
+                catch_up_latencies.append((latency, tweet.created_at))
+        delivered.update(tweet.tw_id for tweet in tweets)
+
+    bot.send_tweets = timed_send_tweets
+    job = FetchAndSendTweetsJob(tweet_stream=tweet_stream)
+    delivery_job = DeliveryJob()
+
+    start = time.time()
+    outage_at = start + args.seconds / 2
+    outage_done = False
+    while time.time() - start < args.seconds:
+        if not outage_done and time.time() >= outage_at:
+            print("Dropping the stream for {}s".format(args.outage))
+            server.fail_with = 503
+            server.drop()
+            outage_done = True
+        if outage_done and server.fail_with:
+            if time.time() >= outage_at + args.outage:
+                server.fail_with = None
+                back_at.append(datetime.utcnow())
+            else:
+                # the accounts keep tweeting while nobody streams them
+                for user in api.users.values():
+                    api._tweet_since_last_call(user)
+        job.run(bot)
+        delivery_job.run(bot)
+        time.sleep(args.interval)
+
+    # stop tweeting and close the stream, which may still buffer the last tweets:
+    # the catch-up polls have to get them
+    server.fail_with = None
+    api.tweet_rate = 0
+    stopped_tweeting_at = datetime.utcnow()
+    tweet_stream.stop()
+    stopped_at = datetime.now()
+    with db.connection_context():
+        for _ in range(100):
+            if not TwitterUser.select().where(TwitterUser.last_fetched < stopped_at).exists():
+                break
+            time.sleep(args.interval)
+            job.run(bot)
+            delivery_job.run(bot)
+    server.stop()
+    with db.connection_context():
+        while delivery_job.deliver(bot):
+            delivery_job.acknowledge()
+        delivery_job.acknowledge()
+        stored = set(tw_id for tw_id, in Tweet.select(Tweet.tw_id).tuples())
+
+    posted = set(t.id for timeline in api.timelines.values() for t in timeline)
+    print("connections: {}, tweets posted: {}, stored: {}, sent: {}, missing: {}, "
+          "sent twice: {}".format(
+              server.connections, len(posted), len(posted & stored),
+              len(posted & set(delivered)), len(posted - set(delivered)),
+              sum(1 for count in delivered.values() if count > 1)))
+    print("messages sent: {}, delivery latency p50 {:.2f}s p90 {:.2f}s p99 {:.2f}s".format(
+        bot.sent, percentile(latencies, 0.5), percentile(latencies, 0.9),
+        percentile(latencies, 0.99)))
+    catch_up_latencies = [latency for latency, tweet_at in catch_up_latencies
+                          if tweet_at < stopped_tweeting_at]
+    print("tweets posted after the outage: {}, delivery latency p50 {:.2f}s p90 {:.2f}s".format(
+        len(catch_up_latencies), percentile(catch_up_latencies, 0.5),
+        percentile(catch_up_latencies, 0.9)))
+    os.remove(db_path)
+
+
+if __name__ == '__main__':
+    main()
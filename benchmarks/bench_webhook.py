@@ -0,0 +1,91 @@
+"""
+Command latency through the webhook listener: time from POSTing a /ping
+update to the bot's reply, with the fake Telegram sender.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_webhook --requests 500 --concurrency 8
+"""
+import argparse
+import json
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+from benchmarks.fakes import FakeSenderBot, FakeTwitterAPI
+
+
+def update_json(update_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': update_id, 'type': 'private'},
+            'from': {'id': update_id, 'first_name': 'Load'},
+            'text': text,
+        },
+    }
+
+
+def post(url, update, secret_token=None):
+    headers = {'Content-Type': 'application/json'}
+    if secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+    req = urllib.request.Request(url, json.dumps(update).encode(), headers)
+    try:
+        return urllib.request.urlopen(req).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    from telegram.ext import CommandHandler
+    from webhook import WebhookUpdater
+
+    bot = FakeSenderBot(FakeTwitterAPI())
+    replied = {}
+    send_message = bot.sendMessage
+
+    def sendMessage(chat_id, text, *a, **kw):
+        send_message(chat_id, text, *a, **kw)
+        replied[chat_id].set()
+
+    bot.sendMessage = sendMessage
+    updater = WebhookUpdater(bot=bot, secret_token='s3cret')
+    updater.dispatcher.add_handler(
+        CommandHandler('ping', lambda bot, update: bot.reply(update, 'Pong!')))
+    updater.start_webhook(listen='127.0.0.1', port=0, url_path='/telegram')
+    while updater.httpd is None:
+        time.sleep(0.01)
+    url = 'http://127.0.0.1:{}/telegram'.format(updater.httpd.server_address[1])
+
+    print("without the secret token: HTTP {}".format(post(url, update_json(0, '/ping'))))
+
+    def ping(update_id):
+        replied[update_id] = Event()
+        start = time.perf_counter()
+        status = post(url, update_json(update_id, '/ping'), 's3cret')
+        replied[update_id].wait(10)
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(ping, range(1, args.requests + 1)))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(latency for _status, latency in results)
+    print("{} /ping: {} ok, {:.0f} req/s, latency p50 {:.1f}ms p99 {:.1f}ms".format(
+        args.requests, sum(1 for status, _ in results if status == 200), args.requests / elapsed,
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000))
+    updater.stop()
+
+
+if __name__ == '__main__':
+    main()
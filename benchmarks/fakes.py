@@ -0,0 +1,357 @@
+"""
+In-process stand-ins for the Twitter and Telegram APIs, so the real job,
+models and command handlers can be exercised without credentials.
+"""
+import json
+import random
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, local
+from urllib.parse import parse_qs
+
+from requests.adapters import HTTPAdapter
+from telegram.error import NetworkError
+from tweepy.error import TweepError
+
+from bot import TwitterForwarderBot
+from stream import FilterStream
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeUser(object):
+    def __init__(self, id, screen_name, name=None):
+        self.id = id
+        self.screen_name = screen_name
+        self.name = name or screen_name.title()
+
+
+class FakeStatus(object):
+    def __init__(self, id, user, full_text, created_at=None, entities=None):
+        self.id = id
+        self.user = user
+        self.full_text = full_text
+        self.created_at = created_at or datetime.utcnow()
+        self.entities = entities or {'urls': []}
+
+
+class FakeList(object):
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.slug = name.replace(' ', '-')
+        self.member_ids = set()
+
+    @property
+    def member_count(self):
+        return len(self.member_ids)
+
+
+class FakeTwitterAPI(object):
+    """
+    Fake tweepy.API. Every account tweets `tweet_rate` tweets per second on
+    average, and every call takes `latency` seconds. `errors` maps HTTP status
+    codes (401, 404, 429...) to the probability of a call failing with them.
+    """
+
+    def __init__(self, screen_names=(), tweet_rate=0.01, latency=0.0, errors=None,
+                 rate_limit=900, rate_window=15 * 60, seed=0):
+        self.tweet_rate = tweet_rate
+        self.latency = latency
+        self.errors = errors or {}
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.random = random.Random(seed)
+        self.users = {}
+        self.timelines = {}
+        self.lists = {}
+        self.calls = 0
+        self._local = local()
+        self._next_tweet_id = 10 ** 15
+        self._window_start = time.time()
+        self._window_calls = 0
+        self._lock = Lock()
+        for screen_name in screen_names:
+            self.add_user(screen_name)
+
+    @property
+    def last_response(self):
+        """Response of the last call, of this thread: copies share the fake's state"""
+        return getattr(self._local, 'last_response', None)
+
+    @last_response.setter
+    def last_response(self, response):
+        self._local.last_response = response
+
+    def __copy__(self):
+        return self
+
+    def add_user(self, screen_name, last_tweet_at=None):
+        user = FakeUser(len(self.users) + 1, screen_name)
+        self.users[screen_name.lower()] = user
+        self.timelines[user.id] = []
+        user.last_tweet_at = last_tweet_at or time.time()
+        return user
+
+    def post_tweet(self, user, text=None):
+        with self._lock:
+            self._next_tweet_id += 1
+            tweet = FakeStatus(self._next_tweet_id, user,
+                               text or "tweet {} by @{} #load".format(self._next_tweet_id,
+                                                                      user.screen_name))
+            self.timelines[user.id].append(tweet)
+        return tweet
+
+    def _tweet_since_last_call(self, user):
+        """Post the tweets the account would have tweeted since we last looked"""
+        now = time.time()
+        expected = (now - user.last_tweet_at) * self.tweet_rate
+        count = int(expected) + (self.random.random() < expected - int(expected))
+        user.last_tweet_at = now
+        for _ in range(min(count, 200)):
+            self.post_tweet(user)
+
+    def _call(self):
+        """Account for a request and raise the injected errors"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            now = time.time()
+            if now - self._window_start >= self.rate_window:
+                self._window_start = now
+                self._window_calls = 0
+            self._window_calls += 1
+            remaining = max(0, self.rate_limit - self._window_calls)
+            headers = {
+                'x-rate-limit-limit': str(self.rate_limit),
+                'x-rate-limit-remaining': str(remaining),
+                'x-rate-limit-reset': str(int(self._window_start + self.rate_window)),
+            }
+            status = 429 if self._window_calls > self.rate_limit else 200
+            for error_status, probability in self.errors.items():
+                if self.random.random() < probability:
+                    status = error_status
+            self.last_response = FakeResponse(status, headers)
+        if status != 200:
+            raise TweepError("Fake error {}".format(status), self.last_response)
+
+    def _user(self, screen_name):
+        try:
+            return self.users[screen_name.lower()]
+        except KeyError:
+            self.last_response = FakeResponse(404)
+            raise TweepError("User not found", self.last_response)
+
+    def user_timeline(self, screen_name, since_id=None, count=20, **kwargs):
+        self._call()
+        user = self._user(screen_name)
+        self._tweet_since_last_call(user)
+        tweets = [t for t in self.timelines[user.id] if since_id is None or t.id > since_id]
+        return list(reversed(tweets))[:count]
+
+    def get_user(self, screen_name):
+        self._call()
+        return self._user(screen_name)
+
+    def create_list(self, name, mode='public', description=''):
+        self._call()
+        twitter_list = FakeList(len(self.lists) + 1, name)
+        self.lists[twitter_list.id] = twitter_list
+        return twitter_list
+
+    def add_list_members(self, screen_name=None, user_id=None, list_id=None, **kwargs):
+        self._call()
+        twitter_list = self.lists[list_id]
+        if len(twitter_list.member_ids) + len(user_id) > 5000:
+            self.last_response = FakeResponse(403)
+            raise TweepError("List is full", self.last_response)
+        twitter_list.member_ids.update(user_id)
+        return twitter_list
+
+    def remove_list_members(self, screen_name=None, user_id=None, list_id=None, **kwargs):
+        self._call()
+        twitter_list = self.lists[list_id]
+        twitter_list.member_ids.difference_update(user_id)
+        return twitter_list
+
+    def list_timeline(self, list_id, since_id=None, max_id=None, count=20, **kwargs):
+        self._call()
+        users = [u for u in self.users.values() if u.id in self.lists[list_id].member_ids]
+        tweets = []
+        for user in users:
+            self._tweet_since_last_call(user)
+            tweets.extend(t for t in self.timelines[user.id]
+                          if (since_id is None or t.id > since_id) and
+                          (max_id is None or t.id <= max_id))
+        tweets.sort(key=lambda t: t.id, reverse=True)
+        return tweets[:count]
+
+    def lookup_users(self, user_ids=None, screen_names=None, **kwargs):
+        self._call()
+        found = [self.users[name.lower()] for name in screen_names or ()
+                 if name.lower() in self.users]
+        if not found:
+            self.last_response = FakeResponse(404)
+            raise TweepError("No user matches for specified terms.", self.last_response)
+        return found
+
+
+class FakeSenderBot(TwitterForwarderBot):
+    """TwitterForwarderBot that records the messages instead of calling Telegram"""
+
+    def __init__(self, tweepy_api_object, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__('123456:fake', tweepy_api_object)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.sent = 0
+        self.send_errors = 0
+        self.photos_fetched = 0
+        self.send_latencies = []
+
+    def sendMessage(self, chat_id, text, *args, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.send_errors += 1
+            raise NetworkError("Fake send error")
+        self.sent += 1
+        self.send_latencies.append(time.perf_counter() - start)
+
+    def send_photo(self, chat_id, photo, caption=None):
+        """Sends like sendMessage, photos sent by URL are counted as fetched by Telegram"""
+        self.sendMessage(chat_id, caption)
+        if photo.startswith('http'):
+            self.photos_fetched += 1
+            return 'file-id-{}'.format(photo)
+        return photo
+
+    def send_media_group(self, chat_id, photos, caption=None):
+        """Sends like send_photo, counted as a single message"""
+        self.sendMessage(chat_id, caption)
+        self.photos_fetched += sum(photo.startswith('http') for photo in photos)
+        return ['file-id-{}'.format(photo) if photo.startswith('http') else photo
+                for photo in photos]
+
+
+class FakeAuth(object):
+    """Auth handler for the fake stream, which doesn't check credentials"""
+
+    def apply_auth(self):
+        return None
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Sends the requests for https://stream.twitter.com to the fake stream server"""
+
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+
+    def send(self, request, **kwargs):
+        request.url = self.url + request.url.split('stream.twitter.com', 1)[1]
+        return super().send(request, **kwargs)
+
+
+class FakeStreamServer(object):
+    """
+    Local HTTP server speaking the filter stream protocol for the accounts of
+    a FakeTwitterAPI: the length-delimited statuses of the followed users, as
+    they tweet. drop() closes the open connections, and new connections fail
+    with HTTP `fail_with` while it's set.
+    """
+
+    def __init__(self, api, tick=0.2):
+        self.api = api
+        self.tick = tick
+        self.fail_with = None
+        self.connections = 0
+        self._generation = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                follow = set(int(i) for i in
+                             parse_qs(body.decode()).get('follow', [''])[0].split(',') if i)
+                if fake.fail_with is not None:
+                    self.send_error(fake.fail_with)
+                    return
+                fake.connections += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.end_headers()
+                fake.serve(self.wfile, follow)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def serve(self, wfile, follow):
+        generation = self._generation
+        users = [u for u in self.api.users.values() if u.id in follow]
+        last_sent = self.api._next_tweet_id
+        try:
+            while generation == self._generation:
+                for user in users:
+                    self.api._tweet_since_last_call(user)
+                tweets = sorted((t for u in users for t in self.api.timelines[u.id]
+                                 if t.id > last_sent), key=lambda t: t.id)
+                for tweet in tweets:
+                    data = json.dumps(self.status_json(tweet)).encode('utf-8')
+                    wfile.write('{}\r\n'.format(len(data)).encode() + data)
+                    last_sent = tweet.id
+                # keep-alive
+                wfile.write(b'\r\n')
+                wfile.flush()
+                time.sleep(self.tick)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    @staticmethod
+    def status_json(tweet):
+        return {
+            'id': tweet.id,
+            'id_str': str(tweet.id),
+            'text': tweet.full_text,
+            'created_at': tweet.created_at.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'in_reply_to_status_id': None,
+            'user': {'id': tweet.user.id, 'id_str': str(tweet.user.id),
+                     'screen_name': tweet.user.screen_name, 'name': tweet.user.name},
+            'entities': tweet.entities,
+        }
+
+    def start(self):
+        Thread(target=self.server.serve_forever, name="fake_stream", daemon=True).start()
+
+    def stop(self):
+        self.drop()
+        self.server.shutdown()
+
+    def drop(self):
+        self._generation += 1
+
+    @property
+    def stream_class(self):
+        """FilterStream connecting to this server instead of Twitter"""
+        url = self.url
+
+        class LocalFilterStream(FilterStream):
+            def new_session(self):
+                super().new_session()
+                self.session.mount('https://', _RedirectAdapter(url))
+
+        return LocalFilterStream
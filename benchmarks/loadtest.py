@@ -0,0 +1,238 @@
+"""
+Offline load test of FetchAndSendTweetsJob and the command handlers.
+
+Builds a synthetic dataset in a scratch SQLite database, plugs the fake
+Twitter API and Telegram sender from benchmarks.fakes into the real job,
+and reports cycle time, queries per cycle, peak Python memory and
+messages per second.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.loadtest --users 10000 --subscriptions 100000 --tweets 5000000
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from benchmarks.fakes import FakeSenderBot, FakeTwitterAPI
+
+
+class QueryCounter(logging.Handler):
+    """Counts the queries peewee logs"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def chunks(rows, size=5000):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def build_dataset(args, api, rng):
+    from models import TwitterUser, TelegramChat, Subscription, Tweet, db
+
+    now = datetime.now()
+    screen_names = ['user{}'.format(i) for i in range(args.users)]
+    for screen_name in screen_names:
+        api.add_user(screen_name)
+
+    with db.atomic():
+        for batch in chunks([{'screen_name': s, 'name': s.title(),
+                              'last_fetched': now - timedelta(seconds=rng.randint(0, 900))}
+                             for s in screen_names]):
+            TwitterUser.insert_many(batch).execute()
+        for batch in chunks([{'chat_id': i + 1, 'tg_type': 'private'}
+                             for i in range(args.chats)]):
+            TelegramChat.insert_many(batch).execute()
+
+    user_ids = [u for u, in TwitterUser.select(TwitterUser.id).tuples()]
+    chat_ids = [c for c, in TelegramChat.select(TelegramChat.id).tuples()]
+
+    # old tweets, ids below the ones the fake API will hand out
+    with db.atomic():
+        tw_id = 0
+        batch = []
+        for i in range(args.tweets):
+            tw_id += 1
+            batch.append({'tw_id': tw_id, 'text': 'old tweet {} #history'.format(tw_id),
+                          'created_at': datetime.utcnow() - timedelta(minutes=args.tweets - i),
+                          'twitter_user': rng.choice(user_ids)})
+            if len(batch) >= 5000:
+                Tweet.insert_many(batch).execute()
+                batch = []
+        if batch:
+            Tweet.insert_many(batch).execute()
+        db.execute_sql(
+            'UPDATE twitteruser SET last_tweet_id = '
+            '(SELECT COALESCE(MAX(tw_id), 0) FROM tweet '
+            'WHERE tweet.twitter_user_id = twitteruser.id)')
+
+    # subscriptions start caught up, so each cycle only delivers fresh tweets
+    last_tweet_ids = dict(TwitterUser.select(TwitterUser.id, TwitterUser.last_tweet_id).tuples())
+    pairs = set()
+    subscriptions = min(args.subscriptions, len(user_ids) * len(chat_ids))
+    while len(pairs) < subscriptions:
+        pairs.add((rng.choice(chat_ids), rng.choice(user_ids)))
+    with db.atomic():
+        for batch in chunks([{'tg_chat': chat, 'tw_user': user,
+                              'last_tweet_id': last_tweet_ids[user]} for chat, user in pairs]):
+            Subscription.insert_many(batch).execute()
+
+
+class FakeUpdate(object):
+    class Chat(object):
+        def __init__(self, chat_id):
+            self.id = chat_id
+            self.type = 'private'
+
+    class Message(object):
+        def __init__(self, chat_id):
+            self.chat = FakeUpdate.Chat(chat_id)
+
+    def __init__(self, chat_id):
+        self.message = FakeUpdate.Message(chat_id)
+
+
+def bench_commands(bot, args, rng, counter):
+    import commands
+
+    results = []
+    for name, run in (
+            ('/sub', lambda chat_id: commands.cmd_sub(
+                bot, FakeUpdate(chat_id), ['user{}'.format(rng.randrange(args.users))
+                                           for _ in range(args.sub_size)])),
+            ('/list', lambda chat_id: commands.cmd_list(bot, FakeUpdate(chat_id))),
+            ('/all', lambda chat_id: commands.cmd_all(bot, FakeUpdate(chat_id))),
+            ('/unsub', lambda chat_id: commands.cmd_unsub(
+                bot, FakeUpdate(chat_id), ['user{}'.format(rng.randrange(args.users))
+                                           for _ in range(args.sub_size)])),
+    ):
+        counter.count = 0
+        start = time.perf_counter()
+        for _ in range(args.commands):
+            run(rng.randint(1, args.chats))
+        elapsed = time.perf_counter() - start
+        results.append((name, elapsed / args.commands, counter.count / args.commands))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--subscriptions', type=int, default=10000)
+    parser.add_argument('--tweets', type=int, default=100000)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--tweet-rate', type=float, default=0.01,
+                        help="tweets per second per account")
+    parser.add_argument('--twitter-latency', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--error-404', type=float, default=0.0)
+    parser.add_argument('--error-401', type=float, default=0.0)
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=10 ** 9)
+    parser.add_argument('--fetch-workers', type=int, default=1)
+    parser.add_argument('--fetch-mode', choices=('users', 'lists'), default='users')
+    parser.add_argument('--commands', type=int, default=20,
+                        help="runs of each command handler")
+    parser.add_argument('--sub-size', type=int, default=20,
+                        help="usernames per /sub and /unsub")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep-db', action='store_true')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tmp = tempfile.mkdtemp(prefix='loadtest-')
+    db_path = os.path.join(tmp, 'loadtest.db')
+
+    import models
+    models.init_database('sqlite:///' + db_path)
+    models.migrate_schema()
+    from delivery import DeliveryJob
+    from job import FetchAndSendTweetsJob
+    from lists import ListTimelineFetcher
+    from models import Subscription, TwitterUser
+    from ratelimit import RateLimitBudget
+
+    errors = {status: p for status, p in ((404, args.error_404), (401, args.error_401),
+                                          (429, args.error_429)) if p}
+    api = FakeTwitterAPI(tweet_rate=args.tweet_rate, latency=args.twitter_latency,
+                         errors=errors, rate_limit=args.rate_limit, seed=args.seed)
+    bot = FakeSenderBot(api, latency=args.telegram_latency)
+
+    start = time.perf_counter()
+    build_dataset(args, api, rng)
+    print("Dataset: {} users, {} chats, {} subscriptions, {} tweets built in {:.1f}s".format(
+        args.users, args.chats, args.subscriptions, args.tweets, time.perf_counter() - start))
+
+    counter = QueryCounter()
+    peewee_logger = logging.getLogger('peewee')
+    peewee_logger.addHandler(counter)
+    peewee_logger.setLevel(logging.DEBUG)
+    peewee_logger.propagate = False
+
+    job = FetchAndSendTweetsJob(
+        fetch_workers=args.fetch_workers,
+        list_fetcher=ListTimelineFetcher() if args.fetch_mode == 'lists' else None)
+    # spend the fake API's limit, rather than the job's guess until the headers come
+    job.timeline_budget = RateLimitBudget(api.rate_limit, api.rate_window)
+    delivery_job = DeliveryJob()
+    unpolled = []
+    print("{:>5} {:>9} {:>9} {:>8} {:>9} {:>9} {:>9} {:>10}".format(
+        'cycle', 'fetch s', 'send s', 'queries', 'api calls', 'messages', 'msgs/s', 'peak MiB'))
+    for cycle in range(1, args.cycles + 1):
+        # let the accounts tweet a bit between cycles
+        time.sleep(0.5)
+        calls, sent = api.calls, bot.sent
+        counter.count = 0
+        cycle_start = datetime.now()
+        tracemalloc.start()
+        start = time.perf_counter()
+        job.run(bot)
+        fetched = time.perf_counter()
+        with models.db.connection_context():
+            unpolled.append(TwitterUser.select().join(Subscription)
+                            .where(TwitterUser.last_fetched < cycle_start)
+                            .distinct().count())
+        # send the whole outbox, the fake sender sends inline
+        with models.db.connection_context():
+            while delivery_job.deliver(bot):
+                delivery_job.acknowledge()
+            delivery_job.acknowledge()
+        elapsed = time.perf_counter() - start
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        messages = bot.sent - sent
+        print("{:>5} {:>9.2f} {:>9.2f} {:>8} {:>9} {:>9} {:>9.0f} {:>10.1f}".format(
+            cycle, fetched - start, elapsed - (fetched - start), counter.count,
+            api.calls - calls, messages, messages / elapsed, peak / 2 ** 20))
+
+    if args.commands:
+        print("{:>8} {:>12} {:>10}".format('command', 'ms/command', 'queries'))
+        for name, seconds, queries in bench_commands(bot, args, rng, counter):
+            print("{:>8} {:>12.2f} {:>10.1f}".format(name, seconds * 1000, queries))
+
+    if args.keep_db:
+        print("Database kept at {}".format(db_path))
+    else:
+        os.remove(db_path)
+
+    # injected errors and a low --rate-limit legitimately leave users for later cycles
+    if not errors and args.rate_limit >= args.users * args.cycles and any(unpolled):
+        print("FAIL: users left unpolled in each cycle: {}".format(unpolled))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,330 @@
+import copy
 import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock, local
 
 import telegram
 import tweepy
+from peewee import fn
 from pytz import timezone, utc
 from telegram import Bot
-from telegram.error import TelegramError
+from telegram.error import BadRequest, TelegramError
+from telegram.utils import request
 
-from models import TelegramChat, TwitterUser
-from util import escape_markdown, prepare_tweet_text
+import metrics
+from models import PhotoFileId, TelegramChat, TwitterUser, Subscription, db
+from sendqueue import SendQueue
+from util import LRUCache, escape_markdown, prepare_tweet_text
 
 
 class TwitterForwarderBot(Bot):
+    RENDER_CACHE_SIZE = 1000
+    # most screen names users/lookup takes per call
+    LOOKUP_USERS_BATCH = 100
+    PROFILE_CACHE_SIZE = 10000
+    PROFILE_CACHE_TTL = 60 * 60
+    PHOTO_CACHE_SIZE = 1000
+    # longest photo caption Telegram takes, longer tweets get the photo and a separate message
+    CAPTION_MAX_LENGTH = 1024
+    MESSAGE_MAX_LENGTH = 4096
 
-    def __init__(self, token, tweepy_api_object, update_offset=0):
+    def __init__(self, token, tweepy_api_object, update_offset=0, native_photos=False):
         super().__init__(token=token)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info("Initializing")
         self.update_offset = update_offset
         self.tw = tweepy_api_object
+        self._local = local()
+        self.send_queue = None
+        self.render_cache = LRUCache(self.RENDER_CACHE_SIZE)
+        # lowercase screen name -> Twitter profile, False for the names Twitter doesn't know
+        self.profile_cache = LRUCache(self.PROFILE_CACHE_SIZE, ttl=self.PROFILE_CACHE_TTL)
+        self.stale_profiles = set()
+        self._stale_profiles_lock = Lock()
+        # send tweet photos as Telegram photos instead of link previews
+        self.native_photos = native_photos
+        # photo url -> Telegram file_id, False for the photos Telegram couldn't get
+        self.photo_cache = LRUCache(self.PHOTO_CACHE_SIZE)
+
+    def twitter_api(self):
+        """
+        This thread's copy of the tweepy API. tweepy keeps the response of the
+        last call on the API object, whose rate limit headers the fetch threads,
+        the list fetcher and the command handlers would otherwise overwrite for
+        each other.
+        """
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = copy.copy(self.tw)
+        return api
+
+    def start_send_queue(self):
+        """Send tweets from a background queue instead of inline in the job"""
+        self.send_queue = SendQueue()
+        self.send_queue.start()
 
     def reply(self, update, text, *args, **kwargs):
         self.sendMessage(chat_id=update.message.chat.id, text=text, *args, **kwargs)
 
-    def send_tweet(self, chat, tweet):
-        try:
-            self.logger.debug("Sending tweet {} to chat {}...".format(
-                tweet.tw_id, chat.chat_id
-            ))
+    def render_tweet(self, tweet, timezone_name, link_preview=True):
+        """Markdown message for a tweet, rendered once per tweet and timezone"""
+        key = (tweet.tw_id, timezone_name, link_preview)
+        text = self.render_cache.get(key)
+        if text is not None:
+            return text
 
-            '''
-            Use a soft-hyphen to put an invisible link to the first
-            image in the tweet, which will then be displayed as preview
-            '''
-            photo_url = ''
-            if tweet.photo_url:
-                photo_url = '[\xad](%s)' % tweet.photo_url
-
-            created_dt = utc.localize(tweet.created_at)
-            if chat.timezone_name is not None:
-                tz = timezone(chat.timezone_name)
-                created_dt = created_dt.astimezone(tz)
-            created_at = created_dt.strftime('%Y-%m-%d %H:%M:%S %Z')
-            self.sendMessage(
-                chat_id=chat.chat_id,
-                disable_web_page_preview=not photo_url,
-                text="""
+        '''
+        Use a soft-hyphen to put an invisible link to the first
+        image in the tweet, which will then be displayed as preview
+        '''
+        photo_url = ''
+        if tweet.photo_url and link_preview:
+            photo_url = '[\xad](%s)' % tweet.photo_url
+
+        created_dt = utc.localize(tweet.created_at)
+        if timezone_name is not None:
+            tz = timezone(timezone_name)
+            created_dt = created_dt.astimezone(tz)
+        created_at = created_dt.strftime('%Y-%m-%d %H:%M:%S %Z')
+        text = """
 {link_preview}*{name}* ([@{screen_name}](https://twitter.com/{screen_name})) at {created_at}:
 {text}
 -- [Link to this Tweet](https://twitter.com/{screen_name}/status/{tw_id})
-"""
-                    .format(
-                    link_preview=photo_url,
-                    text=prepare_tweet_text(tweet.text),
-                    name=escape_markdown(tweet.name),
-                    screen_name=tweet.screen_name,
-                    created_at=created_at,
-                    tw_id=tweet.tw_id,
-                ),
-                parse_mode=telegram.ParseMode.MARKDOWN)
-
-        except TelegramError as e:
-            self.logger.info("Couldn't send tweet {} to chat {}: {}".format(
-                tweet.tw_id, chat.chat_id, e.message
+""".format(
+            link_preview=photo_url,
+            text=prepare_tweet_text(tweet.text),
+            name=escape_markdown(tweet.name),
+            screen_name=tweet.screen_name,
+            created_at=created_at,
+            tw_id=tweet.tw_id,
+        )
+        self.render_cache.put(key, text)
+        return text
+
+    def send_tweet(self, chat, tweet, on_sent=None, on_failed=None):
+        """Send the tweet to the chat, `on_sent()` or `on_failed()` is called once it's done"""
+        self.send_tweets(chat, [tweet], on_sent, on_failed)
+
+    def send_tweets(self, chat, tweets, on_sent=None, on_failed=None):
+        """
+        Send the tweets to the chat in a single message, which has to fit
+        MESSAGE_MAX_LENGTH. Only a lone tweet gets its photo shown.
+        """
+        self.logger.debug("Sending tweets %s to chat %s...",
+                          ', '.join(str(tweet.tw_id) for tweet in tweets), chat.chat_id)
+        tweet = tweets[0]
+        if len(tweets) == 1:
+            text = self.render_tweet(tweet, chat.timezone_name)
+            photo_url = tweet.photo_url
+            photo_urls = tweet.photo_urls.split() or [photo_url]
+        else:
+            text = ''.join(self.render_tweet(t, chat.timezone_name, link_preview=False)
+                           for t in tweets)
+            photo_url = ''
+            photo_urls = []
+        native_photo = self.native_photos and photo_url and \
+            self.photo_cache.get(photo_url) is not False
+        if native_photo:
+            caption = self.render_tweet(tweet, chat.timezone_name, link_preview=False)
+
+        def send():
+            start = time.perf_counter()
+            try:
+                if not native_photo or not self.send_tweet_photo(chat.chat_id, photo_urls,
+                                                                 caption):
+                    self.sendMessage(
+                        chat_id=chat.chat_id,
+                        disable_web_page_preview=not photo_url,
+                        text=text,
+                        parse_mode=telegram.ParseMode.MARKDOWN)
+            except TelegramError as e:
+                metrics.TELEGRAM_SEND_ERRORS.inc(error=e.__class__.__name__)
+                raise
+            metrics.TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - start)
+            now = datetime.utcnow()
+            for t in tweets:
+                metrics.TWEET_DELIVERY_SECONDS.observe((now - t.created_at).total_seconds())
+            if on_sent is not None:
+                on_sent()
+
+        def on_error(chat, e):
+            self.logger.info("Couldn't send tweets {} to chat {}: {}".format(
+                ', '.join(str(t.tw_id) for t in tweets), chat.chat_id, getattr(e, 'message', e)
             ))
+            try:
+                if isinstance(e, TelegramError):
+                    self.handle_send_error(chat, e)
+            finally:
+                # the delivery is acknowledged whatever went wrong
+                if on_failed is not None:
+                    on_failed()
+
+        if self.send_queue is not None:
+            self.send_queue.put(chat, send, on_error)
+            return
+
+        try:
+            send()
+        except Exception as e:
+            if not isinstance(e, TelegramError):
+                self.logger.exception("Unexpected error sending to chat {}".format(chat.chat_id))
+            on_error(chat, e)
+
+    def send_photo(self, chat_id, photo, caption=None):
+        """
+        sendPhoto with a Markdown caption, which Bot.sendPhoto doesn't support.
+        `photo` is a URL or a file_id, returns the file_id of the photo sent.
+        """
+        data = {'chat_id': chat_id, 'photo': photo}
+        if caption:
+            data['caption'] = caption
+            data['parse_mode'] = telegram.ParseMode.MARKDOWN
+        result = request.post('{}/sendPhoto'.format(self.base_url), data)
+        # the largest size comes last
+        return result['photo'][-1]['file_id']
+
+    def send_media_group(self, chat_id, photos, caption=None):
+        """
+        sendMediaGroup of photos, which python-telegram-bot 5.0 doesn't have, with
+        a Markdown caption on the first one. Returns the file_ids of the photos sent.
+        """
+        media = [{'type': 'photo', 'media': photo} for photo in photos]
+        if caption:
+            media[0]['caption'] = caption
+            media[0]['parse_mode'] = telegram.ParseMode.MARKDOWN
+        result = request.post('{}/sendMediaGroup'.format(self.base_url),
+                              {'chat_id': chat_id, 'media': media})
+        return [message['photo'][-1]['file_id'] for message in result]
+
+    def photo_file_id(self, photo_url):
+        """The cached file_id of a photo, False if Telegram can't get it, None if unknown"""
+        file_id = self.photo_cache.get(photo_url)
+        if file_id is not None:
+            return file_id
+        with db.connection_context():
+            row = PhotoFileId.get_or_none(PhotoFileId.photo_url == photo_url)
+            if row is None:
+                return None
+            (PhotoFileId.update(used_at=datetime.now())
+             .where(PhotoFileId.id == row.id)
+             .execute())
+        self.photo_cache.put(photo_url, row.file_id)
+        return row.file_id
+
+    def remember_photo(self, photo_url, file_id):
+        self.photo_cache.put(photo_url, file_id)
+        if file_id is False:
+            return
+        with db.connection_context():
+            (PhotoFileId.insert(photo_url=photo_url, file_id=file_id, used_at=datetime.now())
+             .on_conflict(conflict_target=[PhotoFileId.photo_url],
+                          preserve=[PhotoFileId.file_id, PhotoFileId.used_at])
+             .execute())
 
-            delet_this = None
+    def send_tweet_album(self, chat_id, photo_urls, caption):
+        """
+        Send the photos of a tweet as a Telegram album, captioned on its first
+        photo. Returns False when Telegram can't get one of them.
+        """
+        # the albums Telegram couldn't get, by the urls of their photos
+        album_key = ' '.join(photo_urls)
+        if self.photo_cache.get(album_key) is False:
+            return False
+        photos = []
+        for photo_url in photo_urls:
+            file_id = self.photo_file_id(photo_url)
+            if file_id is False:
+                return False
+            photos.append(file_id or photo_url)
 
-            if e.message == 'Bad Request: group chat was migrated to a supergroup chat':
-                delet_this = True
+        try:
+            file_ids = self.send_media_group(chat_id, photos, caption)
+        except BadRequest as e:
+            if 'parse entities' in e.message:
+                raise
+            # a file_id that isn't valid anymore or a photo Telegram can't get,
+            # which the first photo alone tells apart
+            self.logger.info("Couldn't send album {}: {}".format(album_key, e.message))
+            self.photo_cache.put(album_key, False)
+            return False
+        for photo_url, photo, file_id in zip(photo_urls, photos, file_ids):
+            if photo == photo_url:
+                metrics.PHOTO_FILE_IDS.inc(result='miss')
+                self.remember_photo(photo_url, file_id)
+            else:
+                metrics.PHOTO_FILE_IDS.inc(result='hit')
+        return True
+
+    def send_tweet_photo(self, chat_id, photo_urls, text):
+        """
+        Send a tweet with its photos as a Telegram photo, or an album when it
+        has several. Telegram fetches each photo once, other chats get it again
+        by its file_id. Returns False when Telegram can't get the first photo,
+        the tweet has to be sent as a message. A tweet whose album can't be
+        sent gets its first photo only.
+        """
+        caption = text if len(text) <= self.CAPTION_MAX_LENGTH else None
+        if len(photo_urls) > 1 and self.send_tweet_album(chat_id, photo_urls, caption):
+            if caption is None:
+                self.sendMessage(chat_id=chat_id, text=text, disable_web_page_preview=True,
+                                 parse_mode=telegram.ParseMode.MARKDOWN)
+            return True
+
+        photo_url = photo_urls[0]
+        file_id = self.photo_file_id(photo_url)
+        if file_id is False:
+            return False
+
+        sent = False
+        if file_id is not None:
+            try:
+                self.send_photo(chat_id, file_id, caption)
+                metrics.PHOTO_FILE_IDS.inc(result='hit')
+                sent = True
+            except BadRequest as e:
+                if 'parse entities' in e.message:
+                    raise
+                # the file_id isn't valid anymore, send the photo by its url
+                self.logger.info("Couldn't resend photo {}: {}".format(photo_url, e.message))
+
+        if not sent:
+            try:
+                file_id = self.send_photo(chat_id, photo_url, caption)
+            except BadRequest as e:
+                if 'parse entities' in e.message:
+                    raise
+                self.logger.info("Telegram couldn't get photo {}: {}".format(
+                    photo_url, e.message))
+                metrics.PHOTO_FILE_IDS.inc(result='unavailable')
+                self.remember_photo(photo_url, False)
+                return False
+            metrics.PHOTO_FILE_IDS.inc(result='miss')
+            self.remember_photo(photo_url, file_id)
 
-            if e.message == "Unauthorized":
-                delet_this = True
+        if caption is None:
+            self.sendMessage(chat_id=chat_id, text=text, disable_web_page_preview=True,
+                             parse_mode=telegram.ParseMode.MARKDOWN)
+        return True
 
-            if delet_this:
-                self.logger.info("Marking chat for deletion")
-                chat.delete_soon = True
-                chat.save()
+    def handle_send_error(self, chat, e):
+        delet_this = None
+
+        if e.message == 'Bad Request: group chat was migrated to a supergroup chat':
+            delet_this = True
+
+        if e.message == "Unauthorized":
+            delet_this = True
+
+        if delet_this:
+            self.logger.info("Marking chat for deletion")
+            chat.delete_soon = True
+            # the chat was loaded when the send was queued, don't write back its other fields
+            with db.connection_context():
+                (TelegramChat.update(delete_soon=True)
+                 .where(TelegramChat.id == chat.id)
+                 .execute())
 
     def get_chat(self, tg_chat):
         db_chat, _created = TelegramChat.get_or_create(
@@ -84,23 +333,125 @@ class TwitterForwarderBot(Bot):
         )
         return db_chat
 
-    def get_tw_user(self, tw_username):
-        try:
-            tw_user = self.tw.get_user(tw_username)
-        except tweepy.error.TweepError as err:
-            self.logger.error(err)
-            return None
-
-        db_user, _created = TwitterUser.get_or_create(
-            screen_name=tw_user.screen_name,
-            defaults={
-                'name': tw_user.name,
-            },
-        )
+    def find_tw_user(self, tw_username):
+        """The stored TwitterUser with that screen name, in any case, or None"""
+        return TwitterUser.get_or_none(
+            fn.LOWER(TwitterUser.screen_name) == tw_username.lower())
+
+    def lookup_tw_profiles(self, tw_usernames, use_cache=True):
+        """
+        Twitter profiles of the usernames that exist, by lowercase screen name.
+        Recent answers come from the profile cache, the others from users/lookup.
+        """
+        profiles = {}
+        missing = []
+        for name in tw_usernames:
+            tw_user = self.profile_cache.get(name.lower()) if use_cache else None
+            if tw_user is None:
+                missing.append(name)
+            elif tw_user is not False:
+                profiles[name.lower()] = tw_user
+
+        for i in range(0, len(missing), self.LOOKUP_USERS_BATCH):
+            batch = missing[i:i + self.LOOKUP_USERS_BATCH]
+            try:
+                tw_users = self.tw.lookup_users(screen_names=batch)
+            except tweepy.error.TweepError as err:
+                # users/lookup answers 404 when none of the names exist
+                if err.response is None or err.response.status_code != 404:
+                    self.logger.error(err)
+                    continue
+                tw_users = []
+            found = {tw_user.screen_name.lower(): tw_user for tw_user in tw_users}
+            for name in batch:
+                self.profile_cache.put(name.lower(), found.get(name.lower(), False))
+            profiles.update(found)
+        return profiles
+
+    def resolve_twitter_ids(self, tw_users):
+        """Fill in the numeric ids of the users that don't have one yet"""
+        missing = [u for u in tw_users if u.twitter_id is None]
+        if not missing:
+            return
+        profiles = self.lookup_tw_profiles([u.screen_name for u in missing])
+        with db.atomic():
+            for tw_user in missing:
+                profile = profiles.get(tw_user.screen_name.lower())
+                if profile is None:
+                    continue
+                tw_user.twitter_id = profile.id
+                (TwitterUser.update(twitter_id=profile.id)
+                 .where(TwitterUser.id == tw_user.id)
+                 .execute())
+
+    def schedule_profile_refresh(self, tw_users):
+        """Queue the names of the users not looked up recently for refresh_profiles"""
+        stale = [u.screen_name for u in tw_users
+                 if self.profile_cache.get(u.screen_name.lower()) is None]
+        with self._stale_profiles_lock:
+            self.stale_profiles.update(stale)
+
+    def refresh_profiles(self):
+        """Update the names of the queued users, returns how many changed"""
+        with self._stale_profiles_lock:
+            names = list(self.stale_profiles)
+            self.stale_profiles.clear()
+        if not names:
+            return 0
+
+        updated = 0
+        for tw_user in self.lookup_tw_profiles(names, use_cache=False).values():
+            updated += (TwitterUser.update(name=tw_user.name)
+                        .where(TwitterUser.screen_name == tw_user.screen_name,
+                               TwitterUser.name != tw_user.name)
+                        .execute())
+        return updated
+
+    def subscribe(self, chat, tw_usernames):
+        """
+        Subscribe the chat to the Twitter users, returns the TwitterUsers it got
+        subscribed to, the ones it already was subscribed to, and the usernames
+        that weren't found.
+
+        Known users are read from the database, and their names refreshed later
+        by refresh_profiles. The others are looked up in batches and stored
+        with the subscriptions in one transaction.
+        """
+        names = OrderedDict((name.lower(), name) for name in tw_usernames)
+        tw_users = {u.screen_name.lower(): u for u in TwitterUser.select().where(
+            fn.LOWER(TwitterUser.screen_name) << list(names))}
+        self.schedule_profile_refresh(tw_users.values())
+        missing = [name for key, name in names.items() if key not in tw_users]
+        profiles = self.lookup_tw_profiles(missing) if missing else {}
+
+        with db.atomic():
+            if profiles:
+                (TwitterUser.insert_many([{'screen_name': p.screen_name, 'name': p.name,
+                                           'twitter_id': p.id}
+                                          for p in profiles.values()])
+                 .on_conflict_ignore()
+                 .execute())
+                tw_users.update((u.screen_name.lower(), u) for u in TwitterUser.select().where(
+                    fn.LOWER(TwitterUser.screen_name) << list(profiles)))
 
-        if not _created:
-            if db_user.name != tw_user.name:
-                db_user.name = tw_user.name
-                db_user.save()
+            subscribed_ids = set(tw_user_id for tw_user_id, in (
+                Subscription.select(Subscription.tw_user)
+                .where(Subscription.tg_chat == chat,
+                       Subscription.tw_user << [u.id for u in tw_users.values()])
+                .tuples()))
+            new = [u for u in tw_users.values() if u.id not in subscribed_ids]
+            if new:
+                Subscription.insert_many([{'tg_chat': chat, 'tw_user': u} for u in new]).execute()
 
-        return db_user
+        subscribed = []
+        already_subscribed = []
+        not_found = []
+        for key, name in names.items():
+            tw_user = tw_users.get(key)
+            if tw_user is None:
+                not_found.append(name)
+            elif tw_user.id in subscribed_ids:
+                already_subscribed.append(tw_user)
+            else:
+                subscribed.append(tw_user)
+        return subscribed, already_subscribed, not_found
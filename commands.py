@@ -1,5 +1,5 @@
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from pytz import timezone
 from pytz.exceptions import UnknownTimeZoneError
@@ -9,10 +9,13 @@ import tweepy
 from tweepy.auth import OAuthHandler
 from tweepy.error import TweepError
 
-from models import Subscription
-from util import with_touched_chat, escape_markdown, markdown_twitter_usernames
+from models import Subscription, Delivery, TelegramChat
+from util import (with_touched_chat, escape_markdown, markdown_twitter_usernames,
+                  parse_duration, format_duration)
 
 TIMEZONE_LIST_URL = "https://en.wikipedia.org/wiki/List_of_tz_database_time_zones"
+DIGEST_MIN_INTERVAL = 60
+DIGEST_MAX_INTERVAL = 24 * 60 * 60
 
 def cmd_ping(bot, update):
     bot.reply(update, 'Pong!')
@@ -41,6 +44,7 @@ Here's the commands:
 - /verify - send Twitter verifier code to complete authorization process
 - /export\_friends - generate /sub command to subscribe to all your Twitter friends (authorization required)
 - /set\_timezone - set your [timezone name]({}) (for example Asia/Tokyo)
+- /digest - receive the tweets in batches, e.g. /digest 30m, or right away with /digest off
 - /source - info about source code
 - /help - view help text
 This bot is free open source software, check /source if you want to host it!
@@ -56,25 +60,9 @@ def cmd_sub(bot, update, args, chat=None):
         bot.reply(update, "Use /sub username1 username2 username3 ...")
         return
     tw_usernames = args
-    not_found = []
-    already_subscribed = []
-    successfully_subscribed = []
-
-    for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
-
-        if tw_user is None:
-            not_found.append(tw_username)
-            continue
-
-        if Subscription.select().where(
-                Subscription.tw_user == tw_user,
-                Subscription.tg_chat == chat).count() == 1:
-            already_subscribed.append(tw_user.full_name)
-            continue
-
-        Subscription.create(tg_chat=chat, tw_user=tw_user)
-        successfully_subscribed.append(tw_user.full_name)
+    subscribed, already_subscribed, not_found = bot.subscribe(chat, tw_usernames)
+    already_subscribed = [tw_user.full_name for tw_user in already_subscribed]
+    successfully_subscribed = [tw_user.full_name for tw_user in subscribed]
 
     reply = ""
 
@@ -107,7 +95,7 @@ def cmd_unsub(bot, update, args, chat=None):
     successfully_unsubscribed = []
 
     for tw_username in tw_usernames:
-        tw_user = bot.get_tw_user(tw_username)
+        tw_user = bot.find_tw_user(tw_username)
 
         if tw_user is None or Subscription.select().where(
                 Subscription.tw_user == tw_user,
@@ -118,6 +106,7 @@ def cmd_unsub(bot, update, args, chat=None):
         Subscription.delete().where(
             Subscription.tw_user == tw_user,
             Subscription.tg_chat == chat).execute()
+        Delivery.cancel(chat, tw_user)
 
         successfully_unsubscribed.append(tw_user.full_name)
 
@@ -301,6 +290,40 @@ def cmd_set_timezone(bot, update, args, chat):
             parse_mode=telegram.ParseMode.MARKDOWN)
 
 
+@with_touched_chat
+def cmd_digest(bot, update, args, chat=None):
+    if len(args) < 1:
+        if chat.digest_interval is None:
+            state = "Digest mode is off, tweets are sent as they come."
+        else:
+            state = "Digest mode is on: tweets are sent together at most every {}.".format(
+                format_duration(chat.digest_interval))
+        bot.reply(update, state + " Use /digest 30m (or 2h, 1d...) to receive them in "
+                                  "batches, or /digest off to receive them right away.")
+        return
+
+    if args[0].lower() == 'off':
+        chat.digest_interval = None
+        chat.next_digest_at = None
+        chat.save(only=[TelegramChat.digest_interval, TelegramChat.next_digest_at])
+        bot.reply(update, "Digest mode is off, tweets will be sent as they come.")
+        return
+
+    interval = parse_duration(args[0])
+    if interval is None or not DIGEST_MIN_INTERVAL <= interval <= DIGEST_MAX_INTERVAL:
+        bot.reply(update, "Use /digest followed by a duration between {} and {}, "
+                          "like /digest 30m, or /digest off".format(
+                              format_duration(DIGEST_MIN_INTERVAL),
+                              format_duration(DIGEST_MAX_INTERVAL)))
+        return
+
+    chat.digest_interval = interval
+    chat.next_digest_at = datetime.now() + timedelta(seconds=interval)
+    chat.save(only=[TelegramChat.digest_interval, TelegramChat.next_digest_at])
+    bot.reply(update, "Okay, I'll send you the new tweets together at most every {}.".format(
+        format_duration(interval)))
+
+
 @with_touched_chat
 def handle_chat(bot, update, chat=None):
     bot.reply(update, "Hey! Use commands to talk with me, please! See /help")
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+
+from basejob import DatabaseJob
+from models import Delivery, TelegramChat, Tweet, TwitterUser, db
+from util import worker_name as default_worker_name
+
+
+class DeliveryJob(DatabaseJob):
+    """
+    Sends the tweets of the delivery outbox, which the fetch job fills.
+
+    Each run acknowledges the sends that finished since the previous one in
+    a few batched queries: the sent deliveries are deleted, and the failed
+    ones are retried with exponential backoff, up to MAX_ATTEMPTS times.
+    Then it claims the next due deliveries, as many as keep MAX_IN_FLIGHT
+    sends waiting in the send queue.
+
+    The deliveries pending for a chat are coalesced into as few messages as
+    fit MESSAGE_MAX_LENGTH, except tweets with a photo which are sent alone
+    to keep it shown. So are the retried deliveries, so that a tweet Telegram
+    keeps rejecting only fails itself, not the tweets it was sent with. Chats
+    in digest mode get at most one such batch every digest_interval: they are
+    skipped until their next_digest_at.
+
+    Every bot process runs one. They claim deliveries with a conditional
+    UPDATE, so each delivery is claimed by only one of them at a time.
+    Claims older than CLAIM_TIMEOUT, e.g. the ones in flight when a process
+    stopped, are claimed again: a tweet may be sent twice but is never lost.
+    """
+    MAX_IN_FLIGHT = 1000
+    MAX_ATTEMPTS = 8
+    RETRY_BACKOFF = 30
+    RETRY_BACKOFF_CAP = 60 * 60
+    # claimed deliveries whose send never finished are retried after that
+    CLAIM_TIMEOUT = timedelta(minutes=15)
+    ACK_BATCH_SIZE = 500
+
+    def __init__(self, context=None, interval=2, worker_name=None):
+        super().__init__(context, interval)
+        self.worker_name = worker_name or default_worker_name()
+        self.in_flight = 0
+        self._sent = []
+        self._failed = []
+        self._lock = Lock()
+
+    def run_job(self, bot):
+        self.acknowledge()
+        self.deliver(bot)
+
+    def on_sent(self, deliveries):
+        with self._lock:
+            self._sent.extend(d.id for d in deliveries)
+            self.in_flight -= len(deliveries)
+
+    def on_failed(self, deliveries):
+        with self._lock:
+            self._failed.extend((d.id, d.attempts) for d in deliveries)
+            self.in_flight -= len(deliveries)
+
+    def retry_delay(self, attempts):
+        return min(self.RETRY_BACKOFF * 2 ** (attempts - 1), self.RETRY_BACKOFF_CAP)
+
+    def acknowledge(self):
+        """Record the outcome of the sends that finished"""
+        with self._lock:
+            sent, self._sent = self._sent, []
+            failed, self._failed = self._failed, []
+        if not sent and not failed:
+            return
+
+        now = datetime.now()
+        failed_by_attempts = {}
+        for delivery_id, attempts in failed:
+            failed_by_attempts.setdefault(attempts + 1, []).append(delivery_id)
+        given_up = failed_by_attempts.pop(self.MAX_ATTEMPTS, [])
+        if given_up:
+            self.logger.warning("Giving up on {} deliveries after {} attempts".format(
+                len(given_up), self.MAX_ATTEMPTS))
+
+        with db.atomic():
+            done = sent + given_up
+            for i in range(0, len(done), self.ACK_BATCH_SIZE):
+                Delivery.delete().where(Delivery.id << done[i:i + self.ACK_BATCH_SIZE]).execute()
+            for attempts, ids in failed_by_attempts.items():
+                next_attempt_at = now + timedelta(seconds=self.retry_delay(attempts))
+                for i in range(0, len(ids), self.ACK_BATCH_SIZE):
+                    # unless another process claimed it again meanwhile
+                    (Delivery.update(attempts=attempts, next_attempt_at=next_attempt_at,
+                                     claimed_at=None, claimed_by=None)
+                     .where(Delivery.id << ids[i:i + self.ACK_BATCH_SIZE],
+                            Delivery.claimed_by == self.worker_name)
+                     .execute())
+            if failed:
+                # chats that blocked the bot or went away won't take them anymore
+                (Delivery.delete()
+                 .where(Delivery.tg_chat << TelegramChat.select(TelegramChat.id)
+                        .where(TelegramChat.delete_soon == True))
+                 .execute())
+
+    def deliver(self, bot):
+        """Claim the due deliveries and hand them to the bot to send"""
+        limit = self.MAX_IN_FLIGHT - self.in_flight
+        if limit <= 0:
+            return 0
+        now = datetime.now()
+        claimable = (Delivery.claimed_at.is_null() |
+                     (Delivery.claimed_at < now - self.CLAIM_TIMEOUT))
+        deliveries = list(Delivery.select(Delivery, TelegramChat, Tweet, TwitterUser)
+                          .join(TelegramChat)
+                          .switch(Delivery)
+                          .join(Tweet)
+                          .join(TwitterUser)
+                          .where(Delivery.next_attempt_at <= now,
+                                 claimable,
+                                 TelegramChat.delete_soon == False,
+                                 TelegramChat.next_digest_at.is_null() |
+                                 (TelegramChat.next_digest_at <= now))
+                          .order_by(Delivery.id)
+                          .limit(limit))
+        if not deliveries:
+            return 0
+
+        ids = [d.id for d in deliveries]
+        claimed = set()
+        with db.atomic():
+            for i in range(0, len(ids), self.ACK_BATCH_SIZE):
+                batch = ids[i:i + self.ACK_BATCH_SIZE]
+                # the other processes' claims made since the select are left alone
+                (Delivery.update(claimed_at=now, claimed_by=self.worker_name)
+                 .where(Delivery.id << batch, claimable)
+                 .execute())
+                claimed.update(delivery_id for delivery_id, in
+                               Delivery.select(Delivery.id)
+                               .where(Delivery.id << batch,
+                                      Delivery.claimed_by == self.worker_name,
+                                      Delivery.claimed_at == now)
+                               .tuples())
+            deliveries = [d for d in deliveries if d.id in claimed]
+            digests = {}
+            for delivery in deliveries:
+                chat = delivery.tg_chat
+                if chat.digest_interval is not None:
+                    digests.setdefault(chat.digest_interval, set()).add(chat.id)
+            for interval, chat_ids in digests.items():
+                (TelegramChat.update(next_digest_at=now + timedelta(seconds=interval))
+                 .where(TelegramChat.id << list(chat_ids))
+                 .execute())
+        if not deliveries:
+            return 0
+
+        by_chat = OrderedDict()
+        for delivery in deliveries:
+            by_chat.setdefault(delivery.tg_chat.id, []).append(delivery)
+        self.logger.debug("Sending %s deliveries to %s chats", len(deliveries), len(by_chat))
+        with self._lock:
+            self.in_flight += len(deliveries)
+        for chat_deliveries in by_chat.values():
+            chat = chat_deliveries[0].tg_chat
+            for batch in self.coalesce(bot, chat_deliveries):
+                bot.send_tweets(chat, [d.tweet for d in batch],
+                                on_sent=lambda b=batch: self.on_sent(b),
+                                on_failed=lambda b=batch: self.on_failed(b))
+        return len(deliveries)
+
+    def coalesce(self, bot, deliveries):
+        """Split the deliveries of a chat into batches that each fit a message"""
+        batch = []
+        length = 0
+        for delivery in deliveries:
+            tweet = delivery.tweet
+            if tweet.photo_url or delivery.attempts:
+                yield [delivery]
+                continue
+            tweet_length = len(bot.render_tweet(tweet, delivery.tg_chat.timezone_name,
+                                                link_preview=False))
+            if batch and length + tweet_length > bot.MESSAGE_MAX_LENGTH:
+                yield batch
+                batch = []
+                length = 0
+            batch.append(delivery)
+            length += tweet_length
+        if batch:
+            yield batch
@@ -7,4 +7,17 @@ env = dict(
 # optional
         # TWITTER_ACCESS_TOKEN="VALUE",
         # TWITTER_ACCESS_TOKEN_SECRET="VALUE",
+
+# tuning
+        # FETCH_WORKERS="1",  # threads fetching timelines concurrently
+        # ADAPTIVE_POLLING="1",  # poll busy accounts more often than dormant ones
+        # MAX_STALENESS="900",  # longest time between polls of an account, in seconds
+        # FETCH_MODE="lists",  # "lists" polls Twitter lists instead of accounts, "stream" streams
+        # FETCH_SHARDS="64",  # shards of the accounts the --role worker processes split
+        # NATIVE_PHOTOS="1",  # send tweet photos as Telegram photos instead of link previews
+        # WEBHOOK_URL="https://example.com/telegram",  # get updates on a webhook, not polling
+        # WEBHOOK_PORT="8080",  # port of the webhook listener, behind an SSL-terminating proxy
+        # WEBHOOK_SECRET="VALUE",  # token Telegram sends with the updates
+        # METRICS_PORT="9100",  # serve Prometheus metrics on this port
+        # METRICS_HOST="127.0.0.1",  # address the metrics endpoint listens on
 )
@@ -0,0 +1,75 @@
+import html
+import re
+
+IMAGE_URL_RE = re.compile(r'\.(jpg|jpeg|png|gif)$', re.IGNORECASE)
+
+
+def expand_urls(full_text, url_entities):
+    """Unescape the tweet text, replacing the t.co links with their expanded url"""
+    parts = []
+    pos = 0
+    for url_entity in sorted(url_entities, key=lambda e: e['indices'][0]):
+        start, end = url_entity['indices']
+        if start < pos or full_text[start:end] != url_entity.get('url', full_text[start:end]):
+            # indices don't match the text, replace the link wherever it is instead
+            res = html.unescape(full_text)
+            for url_entity in url_entities:
+                start, end = url_entity['indices']
+                res = res.replace(full_text[start:end], url_entity['expanded_url'])
+            return res
+
+        parts.append(html.unescape(full_text[pos:start]))
+        parts.append(url_entity.get('expanded_url') or full_text[start:end])
+        pos = end
+    parts.append(html.unescape(full_text[pos:]))
+    return ''.join(parts)
+
+
+def photo_urls(entities, extended_media=()):
+    """
+    The tweet's media, of which its entities only have the first one and its
+    extended entities all, or else its first link to an image.
+    """
+    media = extended_media or entities.get('media')
+    if media:
+        return [m['media_url_https'] for m in media]
+    for url_entity in entities['urls']:
+        expanded_url = url_entity.get('expanded_url') or ''
+        if IMAGE_URL_RE.search(expanded_url):
+            return [expanded_url]
+    return []
+
+
+def full_text(tweet):
+    """
+    Full text and entities of a status. Streamed statuses have no full_text,
+    the text of long ones is in their extended_tweet.
+    """
+    if hasattr(tweet, 'full_text'):
+        return tweet.full_text, tweet.entities
+    extended = getattr(tweet, 'extended_tweet', None)
+    if extended is not None:
+        return extended['full_text'], extended.get('entities', tweet.entities)
+    return tweet.text, tweet.entities
+
+
+def extended_media(tweet):
+    """All the media of a status, in its extended_tweet for long streamed ones"""
+    extended = getattr(tweet, 'extended_tweet', None)
+    if extended is not None and 'extended_entities' in extended:
+        return extended['extended_entities'].get('media', [])
+    return getattr(tweet, 'extended_entities', {}).get('media', [])
+
+
+def normalize_tweet(tweet, tw_user):
+    """Tweet row for a tweepy status of `tw_user`"""
+    text, entities = full_text(tweet)
+    photos = photo_urls(entities, extended_media(tweet))
+    return {
+        'tw_id': tweet.id,
+        'text': expand_urls(text, entities['urls']),
+        'created_at': tweet.created_at,
+        'twitter_user': tw_user.id,
+        'photo_url': photos[0] if photos else '',
+        'photo_urls': ' '.join(photos) if len(photos) > 1 else '',
+    }
@@ -1,82 +1,294 @@
-import html
-import logging
 import math
-import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from itertools import chain, islice
 from threading import Event
 
 import tweepy
 from telegram.error import TelegramError
-from telegram.ext import Job
 
-from models import TwitterUser, Tweet, Subscription, db, TelegramChat
+import metrics
+from basejob import DatabaseJob
+from ingest import normalize_tweet
+from lists import ListTimelineFetcher
+from models import TwitterUser, Tweet, Subscription, Delivery, db, TelegramChat
+from ratelimit import RateLimitBudget
 
 INFO_CLEANUP = {
     'NOTFOUND': "Your subscription to @{} was removed because that profile doesn't exist anymore. Maybe the account's name changed?",
     'PROTECTED': "Your subscription to @{} was removed because that profile is protected and can't be fetched.",
 }
 
-class FetchAndSendTweetsJob(Job):
-    # Twitter API rate limit parameters
+class FetchAndSendTweetsJob(DatabaseJob):
+    # Twitter API rate limit parameters, until the response headers tell the real ones
     LIMIT_WINDOW = 15 * 60
     LIMIT_COUNT = 300
     MIN_INTERVAL = 60
+    # how often streamed tweets are stored and sent
+    STREAM_INTERVAL = 5
     TWEET_BATCH_INSERT_COUNT = 100
+    # users read, fetched and committed at a time, so a run's memory doesn't grow with them
+    USER_CHUNK_SIZE = 500
 
     @property
     def interval(self):
-        tw_count = (TwitterUser.select()
-                    .join(Subscription)
-                    .group_by(TwitterUser)
-                    .count())
-        if tw_count >= self.LIMIT_COUNT:
-            return self.LIMIT_WINDOW
-        res = math.ceil(tw_count * self.LIMIT_WINDOW / self.LIMIT_COUNT)
+        if self.tweet_stream is not None:
+            # polling only catches up, and is paced by fetch_tweets
+            return self.STREAM_INTERVAL
+
+        if self.poll_scheduler is not None:
+            # the scheduler picks the users that are due, run as often as the budget allows
+            return max(self.MIN_INTERVAL, math.ceil(self.timeline_budget.delay(1)))
+
+        # spread the timeline budget evenly until the end of the rate limit window
+        tw_users = self.subscribed_users()
+        if self.list_fetcher is not None:
+            # only the users the lists don't cover are polled one by one
+            tw_users = tw_users.where(TwitterUser.twitter_list.is_null() |
+                                      (TwitterUser.last_tweet_id == 0))
+            list_delay = self.list_fetcher.budget.delay(self.list_fetcher.calls_per_run())
+        else:
+            list_delay = 0
+        fraction = self.budget_fraction
+        if fraction == 0:
+            return self.MIN_INTERVAL
+        # the other shards' workers spend the rest of the budget
+        calls = math.ceil(tw_users.count() / fraction)
+        res = math.ceil(max(self.timeline_budget.delay(calls), list_delay))
         return max(self.MIN_INTERVAL, res)
 
-    def __init__(self, context=None):
-        self.repeat = True
-        self.context = context
-        self.name = self.__class__.__name__
-        self._remove = Event()
-        self._enabled = Event()
-        self._enabled.set()
-        self.logger = logging.getLogger(self.name)
+    @property
+    def budget_fraction(self):
+        """Part of the rate limit this process spends, which the shard workers share"""
+        if self.shard_leases is None:
+            return 1
+        return self.shard_leases.fraction
+
+    def __init__(self, context=None, fetch_workers=1, poll_scheduler=None, list_fetcher=None,
+                 tweet_stream=None, shard_leases=None):
+        super().__init__(context)
+        self.fetch_workers = fetch_workers
+        self.timeline_budget = RateLimitBudget(self.LIMIT_COUNT, self.LIMIT_WINDOW)
+        self.poll_scheduler = poll_scheduler
+        self.list_fetcher = list_fetcher
+        self.tweet_stream = tweet_stream
+        self.shard_leases = shard_leases
+
+    def subscribed_users(self, *fields):
+        """The users with subscriptions, only the ones of its shards for a shard worker"""
+        tw_users = (TwitterUser.select(*fields)
+                    .join(Subscription)
+                    .group_by(TwitterUser))
+        if self.shard_leases is not None:
+            tw_users = tw_users.where(self.shard_leases.owns(TwitterUser.id))
+        return tw_users
+
+    def user_chunks(self, started_at):
+        """
+        Yield the subscribed users not fetched since `started_at` in lists of
+        USER_CHUNK_SIZE, least recently fetched first, as light named tuples.
+        Each chunk is read after the previous one was processed.
+        """
+        last = None
+        while True:
+            query = (self.subscribed_users(TwitterUser.id, TwitterUser.screen_name,
+                                           TwitterUser.last_tweet_id, TwitterUser.last_fetched)
+                     .where(TwitterUser.last_fetched < started_at)
+                     .order_by(TwitterUser.last_fetched, TwitterUser.id)
+                     .limit(self.USER_CHUNK_SIZE))
+            if last is not None:
+                # the users this run fetched moved past started_at, the others stay in order
+                query = query.where((TwitterUser.last_fetched > last.last_fetched) |
+                                    ((TwitterUser.last_fetched == last.last_fetched) &
+                                     (TwitterUser.id > last.id)))
+            chunk = list(query.namedtuples())
+            if chunk:
+                yield chunk
+            if len(chunk) < self.USER_CHUNK_SIZE:
+                return
+            last = chunk[-1]
+
+    def fetch_timeline(self, bot, tw_user):
+        start = time.perf_counter()
+        try:
+            tweets = self._user_timeline(bot, tw_user)
+        except tweepy.error.TweepError as e:
+            metrics.TWITTER_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, endpoint='user_timeline',
+                status=e.response.status_code if e.response is not None else 'error')
+            self.timeline_budget.update_from(e.response)
+            if e.response is not None and e.response.status_code == 429:
+                self.timeline_budget.exhaust()
+            raise
+        metrics.TWITTER_REQUEST_SECONDS.observe(
+            time.perf_counter() - start, endpoint='user_timeline', status=200)
+        self.timeline_budget.update_from(getattr(bot.twitter_api(), 'last_response', None))
+        return tweets
+
+    def _user_timeline(self, bot, tw_user):
+        if tw_user.last_tweet_id == 0:
+            # get just the latest tweet
+            self.logger.debug("Fetching latest tweet by %s", tw_user.screen_name)
+            return bot.twitter_api().user_timeline(
+                screen_name=tw_user.screen_name,
+                count=1,
+                tweet_mode='extended')
+
+        # get the fresh tweets
+        self.logger.debug("Fetching new tweets from %s", tw_user.screen_name)
+        return bot.twitter_api().user_timeline(
+            screen_name=tw_user.screen_name,
+            since_id=tw_user.last_tweet_id,
+            tweet_mode='extended')
+
+    def fetch_timelines(self, bot, tw_users):
+        """
+        Yield (tw_user, tweets, error) for every user, fetching their timelines
+        from up to `fetch_workers` threads. Only the caller touches the database.
+        """
+        if self.fetch_workers <= 1:
+            for tw_user in tw_users:
+                if not self.timeline_budget.acquire():
+                    self.logger.debug("- Timeline budget spent, stopping.")
+                    return
+                try:
+                    yield tw_user, self.fetch_timeline(bot, tw_user), None
+                except tweepy.error.TweepError as e:
+                    yield tw_user, None, e
+            return
 
-    def run(self, bot):
-        self.logger.debug("Fetching tweets...")
-        tweet_rows = []
-        # fetch the tw users' tweets
-        tw_users = list((TwitterUser.select()
-                         .join(Subscription)
-                         .group_by(TwitterUser)
-                         .order_by(TwitterUser.last_fetched)))
-        updated_tw_users = []
-        users_to_cleanup = []
+        rate_limited = Event()
 
-        for tw_user in tw_users:
+        def fetch(tw_user):
+            if rate_limited.is_set():
+                return tw_user, None, None
+            if not self.timeline_budget.acquire():
+                self.logger.debug("- Timeline budget spent, stopping.")
+                rate_limited.set()
+                return tw_user, None, None
             try:
-                if tw_user.last_tweet_id == 0:
-                    # get just the latest tweet
-                    self.logger.debug(
-                        "Fetching latest tweet by {}".format(tw_user.screen_name))
-                    tweets = bot.tw.user_timeline(
-                        screen_name=tw_user.screen_name,
-                        count=1,
-                        tweet_mode='extended')
-                else:
-                    # get the fresh tweets
-                    self.logger.debug(
-                        "Fetching new tweets from {}".format(tw_user.screen_name))
-                    tweets = bot.tw.user_timeline(
-                        screen_name=tw_user.screen_name,
-                        since_id=tw_user.last_tweet_id,
-                        tweet_mode='extended')
-                updated_tw_users.append(tw_user)
+                return tw_user, self.fetch_timeline(bot, tw_user), None
             except tweepy.error.TweepError as e:
-                sc = e.response.status_code
+                if e.response is not None and e.response.status_code == 429:
+                    rate_limited.set()
+                return tw_user, None, e
+
+        executor = ThreadPoolExecutor(max_workers=self.fetch_workers)
+        futures = [executor.submit(fetch, tw_user) for tw_user in tw_users]
+        try:
+            for future in as_completed(futures):
+                tw_user, tweets, error = future.result()
+                if tweets is None and error is None:
+                    # skipped after another worker hit the rate limit
+                    continue
+                yield tw_user, tweets, error
+        finally:
+            rate_limited.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def insert_tweets(self, tweet_rows):
+        with metrics.phase('insert'):
+            new_count = Tweet.insert_batch(tweet_rows)
+        metrics.TWEETS_INGESTED.inc(new_count, result='new')
+        metrics.TWEETS_INGESTED.inc(len(tweet_rows) - new_count, result='duplicate')
+        self.logger.debug("- Stored %s new tweets, %s duplicated",
+                          new_count, len(tweet_rows) - new_count)
+
+    def dispatch_tweets(self, bot, tw_users):
+        """Put the new tweets of each user in the delivery outbox of its subscribed chats"""
+        # stored tweets were enqueued along with them, this catches up the new subscriptions
+        count = Delivery.enqueue([tw_user.id for tw_user in tw_users])
+        self.logger.debug("- Enqueued %s deliveries", count)
+
+    def run_job(self, bot):
+        # the new tweets are stored and enqueued for the subscribers chunk by chunk
+        with metrics.phase('fetch'):
+            updated_count, users_to_cleanup = self.fetch_tweets(bot)
+
+        if not updated_count:
+            return
+
+        with metrics.phase('cleanup'):
+            self.cleanup(bot, users_to_cleanup)
+
+    def users_to_fetch(self, bot, started_at):
+        """
+        Returns the (tw_user, tweets) pairs the lists and the stream got, and
+        the users to poll, an iterable read lazily when neither is used.
+        """
+        if self.list_fetcher is None and self.tweet_stream is None:
+            tw_users = chain.from_iterable(self.user_chunks(started_at))
+            listed = streamed = []
+        else:
+            # they follow all the users at once, so these modes aren't read in chunks
+            tw_users = list(self.subscribed_users().order_by(TwitterUser.last_fetched))
+            listed = []
+            streamed = []
+            if self.list_fetcher is not None:
+                listed, tw_users = self.list_fetcher.fetch(bot, tw_users)
+            if self.tweet_stream is not None:
+                streamed, tw_users = self.tweet_stream.fetch(bot, tw_users)
+                # catch up at the pace the budget allows, in the order the stream asks for
+                tw_users = tw_users[:self.timeline_budget.share(self.STREAM_INTERVAL)]
+        if self.poll_scheduler is not None:
+            tw_users = self.poll_scheduler.select(
+                tw_users, int(self.timeline_budget.share(self.MIN_INTERVAL) *
+                              self.budget_fraction))
+        return listed, streamed, tw_users
+
+    def fetch_tweets(self, bot):
+        """
+        Fetch, store and enqueue the new tweets. Returns how many users got
+        updated, and the ones to clean up.
+        """
+        self.logger.debug("Fetching tweets...")
+        started_at = datetime.now()
+        listed, streamed, tw_users = self.users_to_fetch(bot, started_at)
+        updated_count = 0
+        users_to_cleanup = []
+
+        if listed or streamed:
+            tweet_rows = []
+            for tw_user, tweets in listed + streamed:
+                tweet_rows.extend(normalize_tweet(tweet, tw_user) for tweet in tweets)
+            # streamed users may still have to catch up by polling
+            self.store_chunk(bot, [tw_user for tw_user, _tweets in listed + streamed],
+                             [tw_user for tw_user, _tweets in listed], tweet_rows)
+            updated_count += len(listed) + len(streamed)
+
+        tw_users = iter(tw_users)
+        while True:
+            chunk = list(islice(tw_users, self.USER_CHUNK_SIZE))
+            if not chunk:
+                break
+            fetched, rate_limited = self.poll_chunk(bot, chunk, users_to_cleanup)
+            updated_count += len(fetched)
+            if rate_limited:
+                break
+
+        return updated_count, users_to_cleanup
+
+    def poll_chunk(self, bot, tw_users, users_to_cleanup):
+        """
+        Poll the timelines of a chunk of users and store their tweets, adds
+        the users to clean up to `users_to_cleanup`. Returns the users fetched,
+        and whether the rate limit was hit.
+        """
+        tweet_rows = []
+        fetched_tw_users = []
+        polled = 0
+        rate_limited = False
+
+        for tw_user, tweets, error in self.fetch_timelines(bot, tw_users):
+            polled += 1
+            if error is not None:
+                sc = error.response.status_code
                 if sc == 429:
                     self.logger.debug("- Hit ratelimit, breaking.")
+                    rate_limited = True
                     break
 
                 if sc == 401:
@@ -93,99 +305,35 @@ class FetchAndSendTweetsJob(Job):
                     "- Unknown exception, Status code {}".format(sc))
                 continue
 
-            for tweet in tweets:
-                self.logger.debug("- Got tweet: {}".format(tweet.full_text))
-
-                # Check if tweet contains media, else check if it contains a link to an image
-                extensions = ('.jpg', '.jpeg', '.png', '.gif')
-                pattern = '[(%s)]$' % ')('.join(extensions)
-                photo_url = ''
-                tweet_text = html.unescape(tweet.full_text)
-                if 'media' in tweet.entities:
-                    photo_url = tweet.entities['media'][0]['media_url_https']
-                else:
-                    for url_entity in tweet.entities['urls']:
-                        expanded_url = url_entity['expanded_url']
-                        if re.search(pattern, expanded_url):
-                            photo_url = expanded_url
-                            break
-                if photo_url:
-                    self.logger.debug("- - Found media URL in tweet: " + photo_url)
-
-                for url_entity in tweet.entities['urls']:
-                    expanded_url = url_entity['expanded_url']
-                    indices = url_entity['indices']
-                    display_url = tweet.full_text[indices[0]:indices[1]]
-                    tweet_text = tweet_text.replace(display_url, expanded_url)
-
-                tw_data = {
-                    'tw_id': tweet.id,
-                    'text': tweet_text,
-                    'created_at': tweet.created_at,
-                    'twitter_user': tw_user,
-                    'photo_url': photo_url,
-                }
-                try:
-                    t = Tweet.get(Tweet.tw_id == tweet.id)
-                    self.logger.warning("Got duplicated tw_id on this tweet:")
-                    self.logger.warning(str(tw_data))
-                except Tweet.DoesNotExist:
-                    tweet_rows.append(tw_data)
-
-                if len(tweet_rows) >= self.TWEET_BATCH_INSERT_COUNT:
-                    Tweet.insert_many(tweet_rows).execute()
-                    tweet_rows = []
-
-        TwitterUser.update(last_fetched=datetime.now()) \
-            .where(TwitterUser.id << [tw.id for tw in updated_tw_users]).execute()
-
-        if not updated_tw_users:
-            return
-
-        if tweet_rows:
-            Tweet.insert_many(tweet_rows).execute()
-
-        # send the new tweets to subscribers
-        subscriptions = list(Subscription.select()
-                             .where(Subscription.tw_user << updated_tw_users))
-        for s in subscriptions:
-            # are there new tweets? send em all!
-            self.logger.debug(
-                "Checking subscription {} {}".format(s.tg_chat.chat_id, s.tw_user.screen_name))
-
-            if s.last_tweet_id == 0:  # didn't receive any tweet yet
-                try:
-                    tw = s.tw_user.tweets.select() \
-                        .order_by(Tweet.tw_id.desc()) \
-                        .first()
-                    if tw is None:
-                        self.logger.warning("Something fishy is going on here...")
-                    else:
-                        bot.send_tweet(s.tg_chat, tw)
-                        # save the latest tweet sent on this subscription
-                        s.last_tweet_id = tw.tw_id
-                        s.save()
-                except IndexError:
-                    self.logger.debug("- No tweets available yet on {}".format(s.tw_user.screen_name))
-
-                continue
-
-            if s.tw_user.last_tweet_id > s.last_tweet_id:
-                self.logger.debug("- Some fresh tweets here!")
-                for tw in (s.tw_user.tweets.select()
-                                    .where(Tweet.tw_id > s.last_tweet_id)
-                                    .order_by(Tweet.tw_id.asc())
-                           ):
-                    bot.send_tweet(s.tg_chat, tw)
-
-                # save the latest tweet sent on this subscription
-                s.last_tweet_id = s.tw_user.last_tweet_id
-                s.save()
-                continue
-
-            self.logger.debug("- No new tweets here.")
-
-
+            fetched_tw_users.append(tw_user)
+
+            tweet_rows.extend(normalize_tweet(tweet, tw_user) for tweet in tweets)
+            if len(tweet_rows) >= self.TWEET_BATCH_INSERT_COUNT:
+                self.insert_tweets(tweet_rows)
+                tweet_rows = []
+
+        # fetch_timelines stops early once the timeline budget is spent
+        rate_limited = rate_limited or polled < len(tw_users)
+
+        self.store_chunk(bot, fetched_tw_users, fetched_tw_users, tweet_rows)
+        return fetched_tw_users, rate_limited
+
+    def store_chunk(self, bot, updated_tw_users, fetched_tw_users, tweet_rows):
+        """
+        Store the rest of a chunk's tweets, mark its users fetched and catch up
+        their subscriptions.
+        """
+        with db.atomic():
+            if tweet_rows:
+                self.insert_tweets(tweet_rows)
+            if fetched_tw_users:
+                TwitterUser.update(last_fetched=datetime.now()) \
+                    .where(TwitterUser.id << [tw.id for tw in fetched_tw_users]).execute()
+            if updated_tw_users:
+                with metrics.phase('dispatch'):
+                    self.dispatch_tweets(bot, updated_tw_users)
+
+    def cleanup(self, bot, users_to_cleanup):
         self.logger.debug("Starting tw_user cleanup")
         if not users_to_cleanup:
             self.logger.debug("- Nothing to cleanup")
@@ -193,15 +341,19 @@ class FetchAndSendTweetsJob(Job):
             for tw_user, reason in users_to_cleanup:
                 self.logger.debug("- Cleaning up subs on user @{}, {}".format(tw_user.screen_name, reason))
                 message = INFO_CLEANUP[reason].format(tw_user.screen_name)
-                subs = list(tw_user.subscriptions)
+                # polled users are light rows, not models
+                subs = list(Subscription.select(Subscription, TelegramChat)
+                            .join(TelegramChat)
+                            .where(Subscription.tw_user == tw_user.id))
                 for s in subs:
                     chat = s.tg_chat
+                    chat_id = chat.chat_id
                     if chat.delete_soon:
                         self.logger.debug ("- - skipping because of delete_soon chatid={}".format(chat_id))
                         continue
-                    chat_id = chat.chat_id
                     self.logger.debug ("- - bye on chatid={}".format(chat_id))
                     s.delete_instance()
+                    Delivery.cancel(chat, tw_user.id)
 
                     try:
                         bot.sendMessage(chat_id=chat_id, text=message)
@@ -223,8 +375,18 @@ class FetchAndSendTweetsJob(Job):
                             chat.delete_soon = True
                             chat.save()
 
-            self.logger.debug("- Cleaning up TwitterUser @{}".format(tw_user.screen_name, reason))
-            tw_user.delete_instance()
+                self.logger.debug("- Cleaning up TwitterUser @{}".format(tw_user.screen_name))
+                db_user = TwitterUser.get_or_none(TwitterUser.id == tw_user.id)
+                if db_user is None:
+                    continue
+                # the lists' sizes are counted in the database, a deleted member would stay
+                # in its list unseen. Kept if it can't be removed, the next sync retries.
+                if db_user.twitter_list_id is not None and \
+                        (self.list_fetcher or ListTimelineFetcher()).unlist(bot, [db_user]):
+                    continue
+                # its tweets and their deliveries go too, PostgreSQL enforces the foreign keys
+                with db.atomic():
+                    db_user.delete_instance(recursive=True)
 
             self.logger.debug ("- Cleanup finished")
 
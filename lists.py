@@ -0,0 +1,225 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+import tweepy
+from peewee import fn
+
+from models import TwitterList, TwitterUser
+from ratelimit import RateLimitBudget
+
+
+class ListTimelineFetcher(object):
+    """
+    Fetches the tweets of the subscribed users from private Twitter lists of
+    the bot's account that mirror them, one list_timeline call for up to
+    MAX_MEMBERS users instead of one user_timeline call per user.
+
+    Users the lists can't cover are left to per-user polling: the ones whose
+    numeric id is unknown, the ones that couldn't be added, and the ones
+    without any stored tweet yet, which only get their latest tweet. So are
+    the users not polled since they were listed: their tweets from before the
+    list's since_id would be missed otherwise. When a list has more new
+    tweets than MAX_PAGES reach, its members are relisted that way too.
+    """
+    MAX_MEMBERS = 5000
+    # most users lists/members/create_all and destroy_all take per call
+    MEMBERS_BATCH = 100
+    PAGE_SIZE = 200
+    # list timelines only reach ~800 tweets back
+    MAX_PAGES = 4
+    LIMIT_WINDOW = 15 * 60
+    LIMIT_COUNT = 900
+    LIST_NAME = "forwarder {}"
+
+    def __init__(self):
+        self.budget = RateLimitBudget(self.LIMIT_COUNT, self.LIMIT_WINDOW)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def remove_members(self, bot, tw_users):
+        """Take users nobody is subscribed to anymore out of their lists"""
+        subscribed_ids = set(u.id for u in tw_users)
+        self.unlist(bot, [tw_user for tw_user in
+                          TwitterUser.select().where(TwitterUser.twitter_list.is_null(False))
+                          if tw_user.id not in subscribed_ids])
+
+    def unlist(self, bot, tw_users):
+        """Take listed users out of their lists, returns the ones that couldn't be"""
+        leaving = defaultdict(list)
+        for tw_user in tw_users:
+            leaving[tw_user.twitter_list_id].append(tw_user)
+
+        failed = []
+        for twitter_list in TwitterList.select().where(TwitterList.id << list(leaving)):
+            members = leaving[twitter_list.id]
+            for i in range(0, len(members), self.MEMBERS_BATCH):
+                batch = members[i:i + self.MEMBERS_BATCH]
+                try:
+                    bot.tw.remove_list_members(list_id=twitter_list.list_id,
+                                               user_id=[u.twitter_id for u in batch])
+                except tweepy.error.TweepError as e:
+                    self.logger.warning("Couldn't remove members from list {}: {}".format(
+                        twitter_list.list_id, e))
+                    failed.extend(members[i:])
+                    break
+                (TwitterUser.update(twitter_list=None, listed_at=None)
+                 .where(TwitterUser.id << [u.id for u in batch])
+                 .execute())
+                for tw_user in batch:
+                    tw_user.twitter_list = None
+                    tw_user.listed_at = None
+        return failed
+
+    def add_members(self, bot, tw_users):
+        """Add the users that aren't in a list yet, creating lists as they fill up"""
+        joining = [u for u in tw_users if u.twitter_list_id is None and u.twitter_id is not None]
+        if not joining:
+            return
+
+        sizes = dict(TwitterUser.select(TwitterUser.twitter_list, fn.COUNT(TwitterUser.id))
+                     .where(TwitterUser.twitter_list.is_null(False))
+                     .group_by(TwitterUser.twitter_list)
+                     .tuples())
+        lists = list(TwitterList.select().order_by(TwitterList.id))
+        while joining:
+            twitter_list = next((candidate for candidate in lists
+                                 if sizes.get(candidate.id, 0) < self.MAX_MEMBERS), None)
+            if twitter_list is None:
+                try:
+                    created = bot.tw.create_list(name=self.LIST_NAME.format(len(lists) + 1),
+                                                 mode='private')
+                except tweepy.error.TweepError as e:
+                    self.logger.warning("Couldn't create a Twitter list: {}".format(e))
+                    return
+                twitter_list = TwitterList.create(list_id=created.id, name=created.name)
+                lists.append(twitter_list)
+
+            count = min(self.MAX_MEMBERS - sizes.get(twitter_list.id, 0), self.MEMBERS_BATCH)
+            batch, joining = joining[:count], joining[count:]
+            try:
+                bot.tw.add_list_members(list_id=twitter_list.list_id,
+                                        user_id=[u.twitter_id for u in batch])
+            except tweepy.error.TweepError as e:
+                self.logger.warning("Couldn't add members to list {}: {}".format(
+                    twitter_list.list_id, e))
+                return
+            listed_at = datetime.now()
+            (TwitterUser.update(twitter_list=twitter_list, listed_at=listed_at)
+             .where(TwitterUser.id << [u.id for u in batch])
+             .execute())
+            for tw_user in batch:
+                tw_user.twitter_list = twitter_list
+                tw_user.listed_at = listed_at
+            sizes[twitter_list.id] = sizes.get(twitter_list.id, 0) + len(batch)
+
+    def sync(self, bot, tw_users):
+        """Mirror the subscribed users `tw_users` into the lists"""
+        bot.resolve_twitter_ids(tw_users)
+        self.remove_members(bot, tw_users)
+        self.add_members(bot, tw_users)
+
+    def list_timeline(self, bot, twitter_list):
+        """
+        The list's tweets since its since_id, newest first, paging back up to
+        MAX_PAGES, and whether they reach back to since_id. None when the rate
+        limit budget is spent.
+        """
+        api = bot.twitter_api()
+        tweets = []
+        max_id = None
+        for page_number in range(self.MAX_PAGES):
+            if not self.budget.acquire():
+                if page_number == 0:
+                    return None
+                return tweets, False
+            params = dict(list_id=twitter_list.list_id, count=self.PAGE_SIZE,
+                          include_rts=True, tweet_mode='extended')
+            if twitter_list.since_id:
+                params['since_id'] = twitter_list.since_id
+            if max_id is not None:
+                params['max_id'] = max_id
+            try:
+                page = api.list_timeline(**params)
+            except tweepy.error.TweepError as e:
+                self.budget.update_from(e.response)
+                if e.response is not None and e.response.status_code == 429:
+                    self.budget.exhaust()
+                raise
+            self.budget.update_from(getattr(api, 'last_response', None))
+            tweets.extend(page)
+            if len(page) < self.PAGE_SIZE:
+                return tweets, True
+            if not twitter_list.since_id:
+                # a new list only needs its latest tweets to start from
+                return tweets, False
+            max_id = page[-1].id - 1
+        return tweets, False
+
+    def is_covered(self, tw_user):
+        """Whether the user's new tweets can be taken from its list timeline"""
+        return (tw_user.twitter_list_id is not None and tw_user.last_tweet_id != 0 and
+                tw_user.listed_at is not None and tw_user.last_fetched >= tw_user.listed_at)
+
+    def fetch(self, bot, tw_users):
+        """
+        Fetch the new tweets of the users covered by the lists. Returns
+        (tw_user, tweets) pairs for them, and the users to poll one by one.
+        """
+        self.sync(bot, tw_users)
+
+        members = defaultdict(dict)
+        uncovered = []
+        for tw_user in tw_users:
+            if self.is_covered(tw_user):
+                members[tw_user.twitter_list_id][tw_user.twitter_id] = tw_user
+            else:
+                uncovered.append(tw_user)
+
+        fetched = []
+        for twitter_list in TwitterList.select().where(TwitterList.id << list(members)):
+            list_members = members[twitter_list.id]
+            try:
+                result = self.list_timeline(bot, twitter_list)
+            except tweepy.error.TweepError as e:
+                self.logger.warning("Couldn't fetch list {}, polling its members: {}".format(
+                    twitter_list.list_id, e))
+                uncovered.extend(list_members.values())
+                continue
+            if result is None:
+                self.logger.debug("- List timeline budget spent, stopping.")
+                break
+
+            tweets, complete = result
+            if not complete:
+                # the tweets between since_id and the oldest one fetched are only in
+                # the members' own timelines: they're polled before the list covers them again
+                if twitter_list.since_id:
+                    self.logger.warning("More than {} new tweets in list {}, polling its members"
+                                        .format(len(tweets), twitter_list.list_id))
+                listed_at = datetime.now()
+                (TwitterUser.update(listed_at=listed_at)
+                 .where(TwitterUser.twitter_list == twitter_list.id)
+                 .execute())
+                for tw_user in list_members.values():
+                    tw_user.listed_at = listed_at
+                uncovered.extend(list_members.values())
+                list_members = {}
+
+            by_member = defaultdict(list)
+            for tweet in tweets:
+                tw_user = list_members.get(tweet.user.id)
+                if tw_user is not None and tweet.id > tw_user.last_tweet_id:
+                    by_member[tw_user.id].append(tweet)
+            fetched.extend((tw_user, by_member[tw_user.id]) for tw_user in list_members.values())
+
+            if tweets:
+                twitter_list.since_id = max(twitter_list.since_id, tweets[0].id)
+                (TwitterList.update(since_id=twitter_list.since_id)
+                 .where(TwitterList.id == twitter_list.id)
+                 .execute())
+
+        return fetched, uncovered
+
+    def calls_per_run(self):
+        """list_timeline calls one run makes when nothing overflows"""
+        return TwitterList.select().count()
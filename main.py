@@ -1,14 +1,25 @@
+import argparse
 import logging
+import signal
 from os import environ
 
-import tweepy
-from telegram.ext import CommandHandler
-from telegram.ext import Updater
-from telegram.ext.messagehandler import MessageHandler, Filters
-
-from bot import TwitterForwarderBot
-from commands import *
-from job import FetchAndSendTweetsJob
+# Optional settings, read from the environment when present
+OPTIONAL_SETTINGS = (
+    'DATABASE_URL',
+    'FETCH_WORKERS',
+    'ADAPTIVE_POLLING',
+    'MAX_STALENESS',
+    'FETCH_MODE',
+    'FETCH_SHARDS',
+    'NATIVE_PHOTOS',
+    'METRICS_PORT',
+    'METRICS_HOST',
+    'WEBHOOK_URL',
+    'WEBHOOK_LISTEN',
+    'WEBHOOK_PORT',
+    'WEBHOOK_PATH',
+    'WEBHOOK_SECRET',
+)
 
 if "TELEGRAM_BOT_TOKEN" in environ:
     # The project is using environment vars, so load from those
@@ -30,6 +41,7 @@ if "TELEGRAM_BOT_TOKEN" in environ:
             TWITTER_CONSUMER_KEY=environ.get("TWITTER_CONSUMER_KEY"),
             TWITTER_CONSUMER_SECRET=environ.get("TWITTER_CONSUMER_SECRET"),
         )
+    env.update((var, environ[var]) for var in OPTIONAL_SETTINGS if var in environ)
 else:
     # The project isn't using environment vars, so we should use the secrets file instead
     try:
@@ -46,21 +58,64 @@ else:
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--migrate-only', action='store_true',
+                        help="bring the database schema up to date and exit")
+    parser.add_argument('--role', choices=('all', 'bot', 'worker'), default='all',
+                        help="all: serve the commands, fetch and send the tweets in this "
+                             "process; bot: serve the commands and send the tweets; worker: "
+                             "only fetch the tweets of a share of the Twitter users, next to "
+                             "other workers")
+    args = parser.parse_args()
+
+    for var in ('TELEGRAM_BOT_TOKEN', 'TWITTER_CONSUMER_KEY', 'TWITTER_CONSUMER_SECRET'):
+        if var not in env:
+            print(("The required configuration variable {} is missing. "
+                   "Please review secrets.py.").format(var))
+            exit(123)
+
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.WARNING)
+    logging.getLogger('models').setLevel(logging.INFO)
+
+    # set up the database schema, this is a single query when it's up to date
+    from models import init_database, migrate_schema, needs_vacuum, vacuum
+    database = init_database(env.get('DATABASE_URL'))
+    migrate_schema()
+    if args.migrate_only:
+        if needs_vacuum():
+            vacuum()
+        exit(0)
+    if needs_vacuum():
+        logging.getLogger('models').warning(
+            "The retention job can't give the space of pruned tweets back until the database "
+            "is vacuumed: stop the bot and run python main.py --migrate-only, which runs VACUUM")
+
+    import tweepy
+    from telegram.ext import CommandHandler
+    from telegram.ext import JobQueue, Updater
+    from telegram.ext.messagehandler import MessageHandler, Filters
+
+    from bot import TwitterForwarderBot
+    from commands import *
+    from delivery import DeliveryJob
+    from job import FetchAndSendTweetsJob
+    from lists import ListTimelineFetcher
+    from stream import TweetStream
+    from webhook import WebhookUpdater
+    from profiles import ProfileRefreshJob
+    from retention import TweetRetentionJob
+    from scheduler import PollScheduler
+    from shards import ShardLeases
 
     logging.getLogger(TwitterForwarderBot.__name__).setLevel(logging.DEBUG)
     logging.getLogger(FetchAndSendTweetsJob.__name__).setLevel(logging.DEBUG)
+    logging.getLogger(TweetRetentionJob.__name__).setLevel(logging.INFO)
+    logging.getLogger(DeliveryJob.__name__).setLevel(logging.INFO)
 
     # initialize Twitter API
-    try:
-        auth = tweepy.OAuthHandler(env['TWITTER_CONSUMER_KEY'], env['TWITTER_CONSUMER_SECRET'])
-    except KeyError as exc:
-        var = exc.args[0]
-        print(("The required configuration variable {} is missing. "
-               "Please review secrets.py.").format(var))
-        exit(123)
+    auth = tweepy.OAuthHandler(env['TWITTER_CONSUMER_KEY'], env['TWITTER_CONSUMER_SECRET'])
 
     try:
         auth.set_access_token(env['TWITTER_ACCESS_TOKEN'], env['TWITTER_ACCESS_TOKEN_SECRET'])
@@ -71,9 +126,59 @@ if __name__ == '__main__':
 
     twapi = tweepy.API(auth)
 
+    def poll_scheduler():
+        if not env.get('ADAPTIVE_POLLING'):
+            return None
+        return PollScheduler(
+            min_interval=FetchAndSendTweetsJob.MIN_INTERVAL,
+            max_staleness=int(env.get('MAX_STALENESS') or FetchAndSendTweetsJob.LIMIT_WINDOW))
+
     # initialize telegram API
     token = env['TELEGRAM_BOT_TOKEN']
-    updater = Updater(bot=TwitterForwarderBot(token, twapi))
+    bot = TwitterForwarderBot(token, twapi, native_photos=bool(env.get('NATIVE_PHOTOS')))
+    bot.start_send_queue()
+
+    if env.get('METRICS_PORT'):
+        import metrics
+        metrics.instrument_database(database)
+        metrics.Gauge('send_queue_depth', "Messages waiting in the send queue",
+                      function=lambda: bot.send_queue.stats()['depth'])
+        metrics.Gauge('send_queue_throughput', "Messages sent per second over the last minute",
+                      function=lambda: bot.send_queue.stats()['throughput'])
+        metrics.start_http_server(int(env['METRICS_PORT']),
+                                  env.get('METRICS_HOST') or '127.0.0.1')
+
+    if args.role == 'worker':
+        if env.get('FETCH_MODE') in ('lists', 'stream'):
+            print("Fetch workers only support FETCH_MODE=users.")
+            exit(123)
+        shard_leases = ShardLeases(int(env.get('FETCH_SHARDS') or 64))
+        shard_leases.start()
+        job_queue = JobQueue(bot)
+        job_queue.put(FetchAndSendTweetsJob(fetch_workers=int(env.get('FETCH_WORKERS') or 1),
+                                            poll_scheduler=poll_scheduler(),
+                                            shard_leases=shard_leases),
+                      next_t=0)
+        # docker stop sends SIGTERM: hand the shards over before exiting
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            while True:
+                signal.pause()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            job_queue.stop()
+            shard_leases.stop()
+        exit(0)
+
+    # the outbox is sent from its own thread, at its own pace
+    delivery_queue = JobQueue(bot)
+    delivery_queue.put(DeliveryJob(), next_t=0)
+
+    if env.get('WEBHOOK_URL'):
+        updater = WebhookUpdater(bot=bot, secret_token=env.get('WEBHOOK_SECRET'))
+    else:
+        updater = Updater(bot=bot)
     dispatcher = updater.dispatcher
 
     # set commands
@@ -91,11 +196,36 @@ if __name__ == '__main__':
     dispatcher.add_handler(CommandHandler('verify', cmd_verify, pass_args=True))
     dispatcher.add_handler(CommandHandler('export_friends', cmd_export_friends))
     dispatcher.add_handler(CommandHandler('set_timezone', cmd_set_timezone, pass_args=True))
+    dispatcher.add_handler(CommandHandler('digest', cmd_digest, pass_args=True))
     dispatcher.add_handler(MessageHandler([Filters.text], handle_chat))
 
     # put job
     queue = updater.job_queue
-    queue.put(FetchAndSendTweetsJob(), next_t=0)
+    if args.role == 'all':
+        list_fetcher = None
+        tweet_stream = None
+        if env.get('FETCH_MODE') == 'lists':
+            list_fetcher = ListTimelineFetcher()
+        elif env.get('FETCH_MODE') == 'stream':
+            tweet_stream = TweetStream(auth)
+            tweet_stream.start()
+        queue.put(FetchAndSendTweetsJob(fetch_workers=int(env.get('FETCH_WORKERS') or 1),
+                                        poll_scheduler=poll_scheduler(),
+                                        list_fetcher=list_fetcher,
+                                        tweet_stream=tweet_stream),
+                  next_t=0)
+    retention_job = TweetRetentionJob()
+    queue.put(retention_job, next_t=retention_job.interval)
+    profile_refresh_job = ProfileRefreshJob()
+    queue.put(profile_refresh_job, next_t=profile_refresh_job.interval)
 
-    # poll
-    updater.start_polling()
+    if env.get('WEBHOOK_URL'):
+        # receive updates on our own listener, behind an SSL-terminating proxy
+        updater.start_webhook(listen=env.get('WEBHOOK_LISTEN') or '0.0.0.0',
+                              port=int(env.get('WEBHOOK_PORT') or 8080),
+                              url_path=env.get('WEBHOOK_PATH') or '/telegram',
+                              webhook_url=env['WEBHOOK_URL'],
+                              bootstrap_retries=-1)
+    else:
+        # poll
+        updater.start_polling()
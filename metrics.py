@@ -0,0 +1,232 @@
+import logging
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread, local
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# from a tweet being posted to it reaching the chat: minutes, not milliseconds
+DELIVERY_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} takes the labels {}, got {}".format(
+                self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) for the exposition"""
+        raise NotImplementedError
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, _format_labels(self.labelnames, values, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '_total' if not self.name.endswith('_total') else '', key, (), value
+
+
+class Gauge(Metric):
+    """Gauge set by the code, or read from `function` when scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield '', (), (), self.function()
+            return
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield '', key, (), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def expose(self):
+        """All the metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.expose() + '\n' for metric in metrics)
+
+
+REGISTRY = Registry()
+
+TWITTER_REQUEST_SECONDS = Histogram(
+    'twitter_request_seconds', "Latency of the Twitter API calls", ('endpoint', 'status'))
+TWEETS_INGESTED = Counter(
+    'tweets_ingested_total', "Fetched tweets, new or already stored", ('result',))
+JOB_PHASE_SECONDS = Histogram(
+    'job_phase_seconds', "Wall time of each phase of the fetch job", ('phase',))
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', "Database query time, by the job phase running it", ('phase',))
+TELEGRAM_SEND_SECONDS = Histogram(
+    'telegram_send_seconds', "Latency of the Telegram sendMessage calls")
+TELEGRAM_SEND_ERRORS = Counter(
+    'telegram_send_errors_total', "Failed Telegram sends, by error type", ('error',))
+PHOTO_FILE_IDS = Counter(
+    'photo_file_id_lookups_total', "Native photo sends, by whether the photo's file_id was cached",
+    ('result',))
+TWEET_DELIVERY_SECONDS = Histogram(
+    'tweet_delivery_seconds', "Time from a tweet being posted to it being sent to a chat",
+    buckets=DELIVERY_BUCKETS)
+
+_phase = local()
+
+
+@contextmanager
+def phase(name):
+    """Time a job phase, and attribute the queries run meanwhile on this thread to it"""
+    previous = getattr(_phase, 'name', None)
+    _phase.name = name
+    try:
+        with JOB_PHASE_SECONDS.time(phase=name):
+            yield
+    finally:
+        _phase.name = previous
+
+
+def instrument_database(database):
+    """Observe the time of every query `database` runs into DB_QUERY_SECONDS"""
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return execute_sql(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start,
+                                     phase=getattr(_phase, 'name', None) or 'other')
+
+    database.execute_sql = timed_execute_sql
+    return database
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serve /metrics from a daemon thread"""
+    server = MetricsServer((host, port), MetricsRequestHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,16 @@
+from basejob import DatabaseJob
+
+
+class ProfileRefreshJob(DatabaseJob):
+    """
+    Refreshes the names of the Twitter users the commands resolved from the
+    database, so that /sub never waits on Twitter for them.
+    """
+
+    def __init__(self, context=None, interval=5 * 60):
+        super().__init__(context, interval)
+
+    def run_job(self, bot):
+        updated = bot.refresh_profiles()
+        if updated:
+            self.logger.info("Refreshed the names of {} Twitter users".format(updated))
@@ -0,0 +1,116 @@
+import time
+from threading import Lock
+
+
+class RateLimitBudget(object):
+    """
+    Request budget of a Twitter API endpoint for the current rate limit window.
+
+    Starts from a configured guess and follows the x-rate-limit-* headers of
+    the responses, so the real limit of the endpoint (900, 1500...) is used
+    once Twitter has told us about it.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.remaining = limit
+        self.reset_at = time.time() + window
+        # whether the budget comes from the headers yet, rather than the guess
+        self._known = False
+        self._lock = Lock()
+
+    def _roll_window(self, now):
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.window
+
+    def update(self, headers):
+        """Learn the current budget from the rate limit headers of a response"""
+        try:
+            remaining = int(headers['x-rate-limit-remaining'])
+            reset_at = int(headers['x-rate-limit-reset'])
+            limit = int(headers['x-rate-limit-limit']) if 'x-rate-limit-limit' in headers else None
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+            limit_grew = limit is not None and limit > self.limit
+            if limit is not None:
+                self.limit = limit
+            if not self._known or reset_at > self.reset_at or \
+                    (reset_at == self.reset_at and limit_grew):
+                # the first real numbers, a new window, or more than the guess allowed
+                self.remaining = remaining
+                self.reset_at = reset_at
+            elif reset_at == self.reset_at:
+                # responses of concurrent requests may arrive out of order
+                self.remaining = min(self.remaining, remaining)
+            # else it's a late response from the previous window
+            self._known = True
+
+    def update_from(self, response):
+        if response is not None:
+            self.update(response.headers)
+
+    def exhaust(self):
+        """Stop spending until the window resets, e.g. after getting a 429"""
+        with self._lock:
+            self.remaining = 0
+
+    def acquire(self):
+        """Take one request from the budget, or return False if it's spent"""
+        with self._lock:
+            self._roll_window(time.time())
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def share(self, seconds):
+        """Requests that can be spent in the next `seconds` to pace the budget evenly"""
+        with self._lock:
+            now = time.time()
+            self._roll_window(now)
+            seconds_left = max(self.reset_at - now, seconds)
+            return int(self.remaining * seconds / seconds_left)
+
+    def delay(self, calls):
+        """Seconds to wait before spending `calls` requests, pacing them evenly over the window"""
+        with self._lock:
+            now = time.time()
+            self._roll_window(now)
+            seconds_left = self.reset_at - now
+            if self.remaining <= 0:
+                return seconds_left
+            return min(seconds_left, calls * seconds_left / self.remaining)
+
+
+class TokenBucket(object):
+    """Allows `rate` events per second, with bursts of up to `capacity` events"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    @property
+    def is_full(self):
+        self._refill(time.time())
+        return self.tokens >= self.capacity
+
+    def wait_time(self, now=None):
+        """Seconds until an event is allowed"""
+        self._refill(now or time.time())
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill(time.time())
+        self.tokens -= 1
@@ -0,0 +1,103 @@
+from peewee import fn
+
+from basejob import DatabaseJob
+from models import TwitterUser, Tweet, Subscription, Delivery, PhotoFileId, db, is_sqlite
+
+
+class TweetRetentionJob(DatabaseJob):
+    """
+    Prunes the tweets no subscription needs anymore and the least recently
+    used photo file_ids, then gives their space back to the filesystem with
+    an incremental VACUUM.
+
+    For each Twitter user, the tweets older than all of the oldest
+    Subscription.last_tweet_id, the oldest tweet waiting in the delivery
+    outbox and the latest KEEP_LATEST tweets are deleted.
+    """
+    KEEP_LATEST = 10
+    # file_ids of the photos sent natively, the least recently used ones go beyond that
+    PHOTO_FILE_IDS_KEPT = 100000
+    DELETE_BATCH_SIZE = 500
+    VACUUM_BATCH_PAGES = 1000
+
+    def __init__(self, context=None, interval=60 * 60):
+        super().__init__(context, interval)
+        self.stats = {}
+
+    def cutoffs(self):
+        """Yield (tw_user_id, tw_id) pairs: each user's tweets before tw_id can go"""
+        # subscriptions that didn't receive any tweet yet only need the latest one
+        needed = dict(Subscription.select(Subscription.tw_user, fn.MIN(Subscription.last_tweet_id))
+                      .where(Subscription.last_tweet_id > 0)
+                      .group_by(Subscription.tw_user)
+                      .tuples())
+        undelivered = dict(Delivery.select(Tweet.twitter_user, fn.MIN(Tweet.tw_id))
+                           .join(Tweet)
+                           .group_by(Tweet.twitter_user)
+                           .tuples())
+
+        for tw_user_id, in TwitterUser.select(TwitterUser.id).tuples():
+            oldest_kept = (Tweet.select(Tweet.tw_id)
+                           .where(Tweet.twitter_user == tw_user_id)
+                           .order_by(Tweet.tw_id.desc())
+                           .offset(self.KEEP_LATEST - 1)
+                           .limit(1)
+                           .scalar())
+            if oldest_kept is None:
+                continue
+            yield tw_user_id, min(oldest_kept, needed.get(tw_user_id, oldest_kept),
+                                  undelivered.get(tw_user_id, oldest_kept))
+
+    def prune(self, tw_user_id, cutoff):
+        """Delete the user's tweets before `cutoff` in short transactions"""
+        deleted = 0
+        while True:
+            with db.atomic():
+                batch = (Tweet.select(Tweet.id)
+                         .where(Tweet.twitter_user == tw_user_id, Tweet.tw_id < cutoff)
+                         .limit(self.DELETE_BATCH_SIZE))
+                count = Tweet.delete().where(Tweet.id << batch).execute()
+            deleted += count
+            if count < self.DELETE_BATCH_SIZE:
+                return deleted
+
+    def vacuum(self):
+        """Release the free pages in small steps, returns the bytes reclaimed"""
+        if not is_sqlite():
+            # PostgreSQL's autovacuum takes care of it
+            return 0
+        page_size = db.execute_sql('PRAGMA page_size').fetchone()[0]
+        pages_before = db.execute_sql('PRAGMA page_count').fetchone()[0]
+        free_pages = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+        while free_pages > 0:
+            # sqlite3 only steps the pragma once, which releases a single page
+            with db.atomic():
+                for _ in range(min(free_pages, self.VACUUM_BATCH_PAGES)):
+                    db.execute_sql('PRAGMA incremental_vacuum(1)')
+            previous, free_pages = free_pages, db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+            if free_pages >= previous:
+                break
+        pages_after = db.execute_sql('PRAGMA page_count').fetchone()[0]
+        return (pages_before - pages_after) * page_size
+
+    def run_job(self, bot):
+        self.prune_all()
+
+    def prune_all(self):
+        self.logger.debug("Pruning tweets...")
+        deleted = 0
+        for tw_user_id, cutoff in self.cutoffs():
+            deleted += self.prune(tw_user_id, cutoff)
+        evicted = PhotoFileId.evict(self.PHOTO_FILE_IDS_KEPT)
+
+        reclaimed = self.vacuum() if deleted or evicted else 0
+        self.stats = {
+            'tweets_deleted': deleted,
+            'photo_file_ids_evicted': evicted,
+            'bytes_reclaimed': reclaimed,
+            'tweets_kept': Tweet.select().count(),
+        }
+        self.logger.info("Retention: deleted {tweets_deleted} tweets and "
+                         "{photo_file_ids_evicted} photo file_ids, "
+                         "reclaimed {bytes_reclaimed} bytes, {tweets_kept} tweets left"
+                         .format(**self.stats))
@@ -0,0 +1,58 @@
+import heapq
+from datetime import datetime, timedelta
+
+from peewee import fn
+
+from models import Tweet
+
+
+class PollScheduler(object):
+    """
+    Picks which Twitter users to poll on each run, polling busy accounts more
+    often than dormant ones.
+
+    Each user gets a poll interval from its tweet rate over the last
+    RATE_WINDOW, clamped between `min_interval` and `max_staleness`, and users
+    are polled in order of how overdue they are.
+    """
+    RATE_WINDOW = timedelta(days=7)
+
+    def __init__(self, min_interval, max_staleness):
+        self.min_interval = min_interval
+        self.max_staleness = max_staleness
+
+    def tweet_rates(self):
+        """Tweets per second of every user that tweeted within RATE_WINDOW"""
+        since = datetime.utcnow() - self.RATE_WINDOW
+        counts = (Tweet.select(Tweet.twitter_user, fn.COUNT(Tweet.id))
+                  .where(Tweet.created_at >= since)
+                  .group_by(Tweet.twitter_user)
+                  .tuples())
+        window = self.RATE_WINDOW.total_seconds()
+        return {tw_user_id: count / window for tw_user_id, count in counts}
+
+    def poll_interval(self, tw_user, rate):
+        if tw_user.last_tweet_id == 0:
+            # new subscribers are waiting for their first tweet
+            return self.min_interval
+        if not rate:
+            return self.max_staleness
+        return min(max(1 / rate, self.min_interval), self.max_staleness)
+
+    def select(self, tw_users, limit):
+        """
+        Return up to `limit` users that are due, most overdue first. `tw_users`
+        is read once, only the `limit` most overdue are kept meanwhile.
+        """
+        rates = self.tweet_rates()
+        now = datetime.now()
+
+        def due():
+            for tw_user in tw_users:
+                interval = self.poll_interval(tw_user, rates.get(tw_user.id))
+                overdue = (now - tw_user.last_fetched).total_seconds() / interval
+                if overdue >= 1:
+                    yield overdue, tw_user
+
+        return [tw_user for _overdue, tw_user in
+                heapq.nlargest(max(limit, 0), due(), key=lambda item: item[0])]
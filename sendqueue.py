@@ -0,0 +1,178 @@
+import heapq
+import logging
+import re
+import time
+from collections import deque
+from itertools import count
+from threading import Condition, Thread
+
+from telegram.error import TelegramError
+
+from ratelimit import TokenBucket
+
+RETRY_AFTER_RE = re.compile(r'retry after (\d+)', re.IGNORECASE)
+
+
+def retry_after(error):
+    """Seconds Telegram asked us to wait on a flood error, or None for other errors"""
+    seconds = getattr(error, 'retry_after', None)
+    if seconds is not None:
+        return seconds
+    match = RETRY_AFTER_RE.search(error.message)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class SendQueue(object):
+    """
+    Outbound Telegram message queue, drained by a background thread.
+
+    Sends are paced by a global token bucket and one per chat to stay within
+    Telegram's flood limits, keep their order within each chat, and are
+    retried after the delay Telegram asks for when we hit a flood error.
+    """
+    GLOBAL_RATE = 30
+    PRIVATE_CHAT_RATE = 1
+    GROUP_CHAT_RATE = 20 / 60
+    THROUGHPUT_WINDOW = 60
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._cond = Condition()
+        self._pending = {}  # chat_id -> deque of (chat, send, on_error)
+        self._ready = []  # heap of (ready_at, seq, chat_id), one entry per idle chat
+        self._seq = count()
+        self._buckets = {}
+        self._global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._sent_at = deque()
+        self._thread = None
+        self._running = False
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = Thread(target=self._main_loop, name="send_queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def put(self, chat, send, on_error=None):
+        """Queue `send()` for `chat`; `on_error(chat, error)` is called if it raises anything"""
+        with self._cond:
+            self.depth += 1
+            if chat.chat_id in self._pending:
+                self._pending[chat.chat_id].append((chat, send, on_error))
+                return
+            self._pending[chat.chat_id] = deque([(chat, send, on_error)])
+            self._schedule(chat, time.time() + self._bucket(chat).wait_time())
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            now = time.time()
+            while self._sent_at and self._sent_at[0] < now - self.THROUGHPUT_WINDOW:
+                self._sent_at.popleft()
+            return {
+                'depth': self.depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'throughput': len(self._sent_at) / self.THROUGHPUT_WINDOW,
+            }
+
+    def _bucket(self, chat):
+        if chat.chat_id not in self._buckets:
+            rate = self.GROUP_CHAT_RATE if chat.is_group else self.PRIVATE_CHAT_RATE
+            self._buckets[chat.chat_id] = TokenBucket(rate)
+        return self._buckets[chat.chat_id]
+
+    def _schedule(self, chat, ready_at):
+        heapq.heappush(self._ready, (ready_at, next(self._seq), chat.chat_id))
+
+    def _next(self):
+        """Wait for the next message that can be sent, and take it from the queue"""
+        with self._cond:
+            while self._running:
+                if not self._ready:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                ready_at, _seq, chat_id = self._ready[0]
+                wait = max(ready_at - now, self._global_bucket.wait_time(now))
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                heapq.heappop(self._ready)
+                item = self._pending[chat_id].popleft()
+                self._global_bucket.take()
+                self._bucket(item[0]).take()
+                return item
+            return None
+
+    def _done(self, chat, item, delay=None):
+        """Put the chat back in line, or the message itself when it has to be retried"""
+        with self._cond:
+            pending = self._pending[chat.chat_id]
+            if delay is not None:
+                pending.appendleft(item)
+                self._schedule(chat, time.time() + delay)
+                return
+
+            self.depth -= 1
+            if pending:
+                self._schedule(chat, time.time() + self._bucket(chat).wait_time())
+                return
+
+            del self._pending[chat.chat_id]
+            if not self._pending:
+                # nothing queued: forget the chats that could send right away anyway
+                for chat_id in [c for c, b in self._buckets.items() if b.is_full]:
+                    del self._buckets[chat_id]
+
+    def _main_loop(self):
+        while True:
+            item = self._next()
+            if item is None:
+                break
+            chat, send, on_error = item
+
+            try:
+                send()
+            except Exception as e:
+                delay = retry_after(e) if isinstance(e, TelegramError) else None
+                if delay is not None:
+                    self.logger.info("Flood limit on chat {}, retrying in {}s".format(
+                        chat.chat_id, delay))
+                    self.retried += 1
+                    self._done(chat, item, delay)
+                    continue
+
+                self.failed += 1
+                if not isinstance(e, TelegramError):
+                    self.logger.exception("Unexpected error sending to chat {}".format(
+                        chat.chat_id))
+                # whoever queued it is told about every failure, e.g. to retry it later
+                if on_error is not None:
+                    try:
+                        on_error(chat, e)
+                    except Exception:
+                        self.logger.exception("Error handling a failed send to chat {}".format(
+                            chat.chat_id))
+            else:
+                self.sent += 1
+                self._sent_at.append(time.time())
+
+            self._done(chat, item)
@@ -0,0 +1,159 @@
+import logging
+import time
+from datetime import datetime, timedelta
+from threading import Condition, Thread
+
+from models import FetchShard, FetchWorker, db
+from util import worker_name as default_worker_name
+
+
+class ShardLeases(object):
+    """
+    Leases of the shards of Twitter users this worker process fetches.
+
+    The users are split into `shard_count` shards by TwitterUser.id modulo
+    `shard_count`, and every worker holds leases on its fair share of them. A
+    background thread heartbeats every HEARTBEAT_INTERVAL: it renews this
+    worker's leases, releases the shards beyond its share when workers joined,
+    and claims free or expired ones when workers left, so the shards of a
+    worker that died are taken over within LEASE_TTL.
+
+    Right after a shard changes hands, both workers may fetch it once.
+    """
+    HEARTBEAT_INTERVAL = 10
+    LEASE_TTL = 30
+
+    def __init__(self, shard_count, worker_name=None):
+        self.shard_count = shard_count
+        self.worker_name = worker_name or default_worker_name()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self._owned = frozenset()
+        self._renewed_at = 0
+        self._cond = Condition()
+        self._thread = None
+        self._running = False
+
+    @property
+    def owned(self):
+        """Shards this worker holds, none once its leases may have expired"""
+        if time.monotonic() - self._renewed_at >= self.LEASE_TTL - self.HEARTBEAT_INTERVAL:
+            return frozenset()
+        return self._owned
+
+    @property
+    def fraction(self):
+        """Part of the users, and of the shared rate limit, this worker has"""
+        return len(self.owned) / self.shard_count
+
+    def owns(self, field):
+        """Query expression matching the rows of `field` (a TwitterUser id) in the owned shards"""
+        # the modulo in integer arithmetic: peewee's % is LIKE, and a literal % in the
+        # SQL is a parameter placeholder for psycopg2
+        shard = field - (field / self.shard_count) * self.shard_count
+        return shard << sorted(self.owned)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        # hold shards before the first job run
+        self._heartbeat_safely()
+        self._thread = Thread(target=self._main_loop, name="shard_leases", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop heartbeating and hand the shards over right away"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        with db.connection_context():
+            with db.atomic():
+                (FetchShard.update(owner=None)
+                 .where(FetchShard.owner == self.worker_name)
+                 .execute())
+                FetchWorker.delete().where(FetchWorker.name == self.worker_name).execute()
+        self._owned = frozenset()
+
+    def _main_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.HEARTBEAT_INTERVAL)
+                if not self._running:
+                    break
+            self._heartbeat_safely()
+
+    def _heartbeat_safely(self):
+        try:
+            with db.connection_context():
+                self.heartbeat()
+        except Exception as e:
+            # the leases run out by themselves if this keeps failing
+            self.logger.warning("Shard lease heartbeat failed: {}".format(e))
+
+    def fair_share(self, workers):
+        """How many shards this worker should hold, among the live `workers` ordered by name"""
+        base, extra = divmod(self.shard_count, len(workers))
+        return base + (1 if workers.index(self.worker_name) < extra else 0)
+
+    def heartbeat(self):
+        """Renew, release and claim leases, returns the shards held"""
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=self.LEASE_TTL)
+        with db.atomic():
+            FetchShard.insert_many([{'shard': s, 'owner': None}
+                                    for s in range(self.shard_count)]) \
+                .on_conflict_ignore().execute()
+
+            updated = (FetchWorker.update(heartbeat_at=now)
+                       .where(FetchWorker.name == self.worker_name)
+                       .execute())
+            if not updated:
+                FetchWorker.create(name=self.worker_name, heartbeat_at=now)
+            FetchWorker.delete().where(
+                FetchWorker.heartbeat_at < now - timedelta(seconds=self.LEASE_TTL)).execute()
+            workers = [name for name, in FetchWorker.select(FetchWorker.name)
+                       .order_by(FetchWorker.name).tuples()]
+            share = self.fair_share(workers)
+
+            # leases that expired meanwhile may have been claimed by another worker already
+            (FetchShard.update(expires_at=expires_at)
+             .where(FetchShard.owner == self.worker_name, FetchShard.expires_at >= now)
+             .execute())
+            owned = [s for s, in FetchShard.select(FetchShard.shard)
+                     .where(FetchShard.owner == self.worker_name,
+                            FetchShard.expires_at > now)
+                     .order_by(FetchShard.shard).tuples()]
+
+            if len(owned) > share:
+                released = owned[share:]
+                owned = owned[:share]
+                (FetchShard.update(owner=None)
+                 .where(FetchShard.shard << released, FetchShard.owner == self.worker_name)
+                 .execute())
+
+            free = ((FetchShard.owner.is_null()) | (FetchShard.expires_at < now) |
+                    (FetchShard.owner == self.worker_name))
+            if len(owned) < share:
+                candidates = [s for s, in FetchShard.select(FetchShard.shard)
+                              .where(free, FetchShard.shard.not_in(owned))
+                              .order_by(FetchShard.shard).tuples()]
+                for shard in candidates:
+                    if len(owned) >= share:
+                        break
+                    # only one of the workers racing for a shard updates its row
+                    claimed = (FetchShard.update(owner=self.worker_name, expires_at=expires_at)
+                               .where(FetchShard.shard == shard, free)
+                               .execute())
+                    if claimed:
+                        owned.append(shard)
+
+        owned = frozenset(owned)
+        if owned != self._owned:
+            self.logger.info("Fetching {} of {} shards with {} workers".format(
+                len(owned), self.shard_count, len(workers)))
+        self._owned = owned
+        self._renewed_at = time.monotonic()
+        return owned
@@ -0,0 +1,226 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from queue import Queue, Empty
+from threading import Condition, Event, Thread
+
+import tweepy
+
+
+class FilterStream(tweepy.Stream):
+    """tweepy Stream that gives up on the first error, so TweetStream decides when to reconnect"""
+
+    def _run(self):
+        try:
+            super()._run()
+        except Exception:
+            # already logged by the listener's on_exception
+            pass
+
+    def on_closed(self, resp):
+        self.running = False
+
+
+class TweetStreamListener(tweepy.StreamListener):
+    def __init__(self, tweet_stream, follow_ids):
+        super().__init__()
+        self.tweet_stream = tweet_stream
+        self.follow_ids = follow_ids
+        self.connected = Event()
+
+    def on_connect(self):
+        self.connected.set()
+
+    def on_status(self, status):
+        # the filter stream also brings replies to and retweets of the followed users
+        if status.user.id in self.follow_ids:
+            self.tweet_stream.queue.put(status)
+
+    def on_error(self, status_code):
+        self.tweet_stream.logger.warning("Stream connection failed: HTTP {}".format(status_code))
+        self.tweet_stream.last_error = status_code
+        return False
+
+    def on_exception(self, exception):
+        self.tweet_stream.logger.warning("Stream connection lost: {}".format(exception))
+
+    def on_timeout(self):
+        self.tweet_stream.logger.warning("Stream connection timed out")
+        return False
+
+    def on_disconnect(self, notice):
+        self.tweet_stream.logger.warning("Stream disconnected by Twitter: {}".format(notice))
+        return False
+
+
+class TweetStream(object):
+    """
+    Receives the tweets of the subscribed users from a filter stream following
+    their ids, held open by a background thread.
+
+    The thread reconnects with exponential backoff, and follows the new set of
+    ids by opening a second connection before closing the first one, so that
+    changing it doesn't leave a gap. `covered_since` tells since when each id
+    has been followed without interruption: tweets from before that have to be
+    caught up with by polling the user.
+
+    The tweets streamed meanwhile are held until that poll, at most MAX_HELD
+    per user, and the users who have some are polled first.
+    """
+    # Twitter's limit of followed ids for a standard filter stream
+    MAX_FOLLOW = 5000
+    BACKOFF_START = 5
+    BACKOFF_CAP = 320
+    # after an HTTP 420, Twitter asks to wait at least a minute
+    RATE_LIMITED_BACKOFF = 60
+    CONNECT_TIMEOUT = 30
+    # Twitter sends keep-alives every 30 seconds
+    READ_TIMEOUT = 90
+    # a poll gets that many tweets at most, the older held ones would be fetched by then
+    MAX_HELD = 200
+    stream_class = FilterStream
+
+    def __init__(self, auth):
+        self.auth = auth
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue = Queue()
+        self.covered_since = {}
+        # streamed tweets of the users to poll, by twitter id
+        self.held = defaultdict(list)
+        self.last_error = None
+        self._wanted = frozenset()
+        self._cond = Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = Thread(target=self._main_loop, name="tweet_stream", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def follow(self, twitter_ids):
+        """Follow these ids from now on, reconnecting in the background if they changed"""
+        wanted = frozenset(twitter_ids)
+        with self._cond:
+            if wanted != self._wanted:
+                self._wanted = wanted
+                self._cond.notify()
+
+    def _connect(self, follow_ids):
+        """Open a stream following `follow_ids`, returns it once connected or None"""
+        listener = TweetStreamListener(self, follow_ids)
+        stream = self.stream_class(self.auth, listener, timeout=self.READ_TIMEOUT, daemon=True)
+        stream.filter(follow=[str(i) for i in follow_ids], is_async=True)
+        for _ in range(self.CONNECT_TIMEOUT):
+            if listener.connected.wait(1):
+                return stream
+            if not stream.running:
+                return None
+        stream.disconnect()
+        return None
+
+    def _main_loop(self):
+        stream = None
+        backoff = self.BACKOFF_START
+        while True:
+            with self._cond:
+                while self._running and not self._wanted:
+                    self._cond.wait()
+                if not self._running:
+                    break
+                follow_ids = self._wanted
+
+            self.last_error = None
+            new_stream = self._connect(follow_ids)
+            if new_stream is None:
+                if self.last_error == 420:
+                    backoff = max(backoff, self.RATE_LIMITED_BACKOFF)
+                self.logger.info("Reconnecting to the stream in {}s".format(backoff))
+                with self._cond:
+                    self._cond.wait(backoff)
+                backoff = min(backoff * 2, self.BACKOFF_CAP)
+                continue
+
+            backoff = self.BACKOFF_START
+            now = datetime.now()
+            if stream is not None and stream.running:
+                # the old connection was open until now, the new ids are the only ones not covered
+                stream.disconnect()
+                self.covered_since = {i: self.covered_since.get(i, now) for i in follow_ids}
+            else:
+                self.covered_since = {i: now for i in follow_ids}
+            stream = new_stream
+            self.logger.info("Streaming the tweets of {} users".format(len(follow_ids)))
+
+            with self._cond:
+                while self._running and stream.running and self._wanted == follow_ids:
+                    self._cond.wait(1)
+            if not stream.running:
+                self.logger.warning("Stream connection closed")
+                self.covered_since = {}
+
+        if stream is not None:
+            stream.disconnect()
+        self.covered_since = {}
+
+    def fetch(self, bot, tw_users):
+        """
+        Take the streamed tweets of `tw_users` and follow them from now on.
+        Returns (tw_user, tweets) pairs for the users that tweeted, and the
+        users to poll: the ones the stream doesn't cover, and the ones not
+        polled since it started covering them, those with held tweets first.
+
+        The streamed tweets of the users to poll are held until they were
+        polled: storing them would move the users' last_tweet_id past the
+        tweets the poll has yet to catch up with, which then would never be
+        fetched nor sent.
+        """
+        bot.resolve_twitter_ids(tw_users)
+        followed = [u for u in tw_users if u.twitter_id is not None][:self.MAX_FOLLOW]
+        self.follow(u.twitter_id for u in followed)
+
+        covered_since = self.covered_since
+        to_poll = [u for u in tw_users
+                   if u.twitter_id not in covered_since or
+                   u.last_fetched < covered_since[u.twitter_id]]
+
+        waiting = set(u.twitter_id for u in to_poll)
+        by_twitter_id = dict((u.twitter_id, u) for u in followed)
+        tweets = defaultdict(list)
+        while True:
+            try:
+                status = self.queue.get_nowait()
+            except Empty:
+                break
+            tw_user = by_twitter_id.get(status.user.id)
+            if tw_user is None:
+                continue
+            if tw_user.twitter_id in waiting:
+                held = self.held[tw_user.twitter_id]
+                held.append(status)
+                del held[:-self.MAX_HELD]
+            elif status.id > tw_user.last_tweet_id:
+                tweets[tw_user].append(status)
+
+        # the poll got the held tweets up to when it ran, the others are new
+        for twitter_id in [i for i in self.held if i not in waiting]:
+            held = self.held.pop(twitter_id)
+            tw_user = by_twitter_id.get(twitter_id)
+            if tw_user is not None:
+                new = [s for s in held if s.id > tw_user.last_tweet_id]
+                if new:
+                    tweets[tw_user] = new + tweets[tw_user]
+
+        # the users who tweeted meanwhile catch up first
+        to_poll.sort(key=lambda u: u.twitter_id not in self.held)
+        return list(tweets.items()), to_poll
@@ -1,5 +1,11 @@
+from collections import OrderedDict
 from functools import wraps
+from threading import Lock
+import os
 import re
+import socket
+import time
+import uuid
 
 
 def with_touched_chat(f):
@@ -16,31 +22,120 @@ def with_touched_chat(f):
     return wrapper
 
 
+class LRUCache(object):
+    """
+    Thread-safe mapping that evicts the least recently used entries past
+    `maxsize`, and the entries older than `ttl` seconds if given.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = value, expires_at
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+def worker_name():
+    """Name of this process among the bot's, unique even when a pid is reused"""
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+
+
+DURATION_RE = re.compile(r'^(\d+)\s*([smhd]?)$', re.IGNORECASE)
+DURATION_UNITS = (('d', 24 * 60 * 60), ('h', 60 * 60), ('m', 60), ('s', 1))
+
+
+def parse_duration(text):
+    """Seconds in a duration like 90s, 30m, 2h or 1d (minutes by default), or None"""
+    match = DURATION_RE.match(text.strip())
+    if match is None:
+        return None
+    return int(match.group(1)) * dict(DURATION_UNITS)[match.group(2).lower() or 'm']
+
+
+def format_duration(seconds):
+    """Shortest of 1d, 2h, 30m or 90s for a number of seconds"""
+    for unit, unit_seconds in DURATION_UNITS:
+        if seconds % unit_seconds == 0:
+            return '{}{}'.format(seconds // unit_seconds, unit)
+
+
+TWITTER_USERNAME_RE = re.compile(r'@([A-Za-z0-9_\\]+)')
+TWITTER_HASHTAG_RE = re.compile(r'#([^\s]*)')
+
+# Hashtags and usernames in one alternation, so that prepare_tweet_text links
+# both in a single scan of the escaped text
+TWITTER_LINK_RE = re.compile(r'#([^\s]*)|@([A-Za-z0-9_\\]+)')
+
+
 def escape_markdown(text):
     """Helper function to escape telegram markup symbols"""
-    escape_chars = '\*_`\['
-    return re.sub(r'([%s])' % escape_chars, r'\\\1', text)
+    return (text.replace('*', r'\*').replace('_', r'\_')
+            .replace('`', r'\`').replace('[', r'\['))
 
 
 def markdown_twitter_usernames(text):
     """Restore markdown escaped usernames and make them link to twitter"""
-    return re.sub(r'@([A-Za-z0-9_\\]+)',
-                  lambda s: '[@{username}](https://twitter.com/{username})'
-                  .format(username=s.group(1).replace(r'\_', '_')),
-                  text)
+    return TWITTER_USERNAME_RE.sub(
+        lambda s: '[@{username}](https://twitter.com/{username})'
+        .format(username=s.group(1).replace(r'\_', '_')),
+        text)
 
 
 def markdown_twitter_hashtags(text):
     """Restore markdown escaped hashtags and make them link to twitter"""
-    return re.sub(r'#([^\s]*)',
-                  lambda s: '[#{tag}](https://twitter.com/hashtag/{tag})'
-                  .format(tag=s.group(1).replace(r'\_', '_')),
-                  text)
+    return TWITTER_HASHTAG_RE.sub(
+        lambda s: '[#{tag}](https://twitter.com/hashtag/{tag})'
+        .format(tag=s.group(1).replace(r'\_', '_')),
+        text)
+
+
+def _username_link(match):
+    username = match.group(1).replace(r'\_', '_')
+    return '[@' + username + '](https://twitter.com/' + username + ')'
+
+
+def _twitter_link(match):
+    if match.lastindex == 2:
+        username = match.group(2).replace(r'\_', '_')
+        return '[@' + username + '](https://twitter.com/' + username + ')'
+    # usernames inside a hashtag are linked before the hashtag itself
+    tag = match.group(1)
+    if '@' in tag:
+        tag = TWITTER_USERNAME_RE.sub(_username_link, tag)
+    tag = tag.replace(r'\_', '_')
+    return '[#' + tag + '](https://twitter.com/hashtag/' + tag + ')'
 
 
 def prepare_tweet_text(text):
-    """Do all escape things for tweet text"""
+    """
+    Do all escape things for tweet text, linking usernames and hashtags in a
+    single pass. Same result as running escape_markdown, markdown_twitter_usernames
+    and markdown_twitter_hashtags one after the other.
+    """
     res = escape_markdown(text)
-    res = markdown_twitter_usernames(res)
-    res = markdown_twitter_hashtags(res)
-    return res
+    if '@' not in res and '#' not in res:
+        return res
+    return TWITTER_LINK_RE.sub(_twitter_link, res)
@@ -0,0 +1,85 @@
+import hmac
+import logging
+from socketserver import ThreadingMixIn
+from time import sleep
+
+from telegram.error import InvalidToken, TelegramError, Unauthorized
+from telegram.ext import Updater
+from telegram.utils import request
+from telegram.utils.webhookhandler import WebhookHandler, WebhookServer, _InvalidPost
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class SecretWebhookHandler(WebhookHandler):
+    """Rejects the requests that don't carry the webhook's secret token"""
+
+    def _validate_post(self):
+        super()._validate_post()
+        secret_token = self.server.secret_token
+        if secret_token and not hmac.compare_digest(
+                self.headers.get(SECRET_TOKEN_HEADER, ''), secret_token):
+            raise _InvalidPost(403)
+
+
+class ThreadedWebhookServer(ThreadingMixIn, WebhookServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, update_queue, webhook_path, secret_token=None):
+        super().__init__(server_address, SecretWebhookHandler, update_queue, webhook_path)
+        self.secret_token = secret_token
+
+
+class WebhookUpdater(Updater):
+    """
+    Updater receiving the updates on a webhook instead of polling getUpdates.
+
+    Unlike Updater.start_webhook's server, this one handles each request in
+    its own thread and checks the secret token Telegram sends along with the
+    updates. SSL is expected to be terminated by a reverse proxy or load
+    balancer in front of it.
+    """
+
+    def __init__(self, *args, secret_token=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.secret_token = secret_token
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def _start_webhook(self, listen, port, url_path, cert, key, bootstrap_retries, clean,
+                       webhook_url):
+        if not url_path.startswith('/'):
+            url_path = '/{}'.format(url_path)
+        self.httpd = ThreadedWebhookServer((listen, port), self.update_queue, url_path,
+                                           self.secret_token)
+        if webhook_url:
+            self._bootstrap(max_retries=bootstrap_retries, clean=clean, webhook_url=webhook_url)
+        self.logger.info("Listening for updates on {}:{}{}".format(listen, port, url_path))
+        self.httpd.serve_forever(poll_interval=1)
+
+    def set_webhook(self, webhook_url):
+        """setWebhook, with the secret token that Bot.setWebhook doesn't know about"""
+        data = {'url': webhook_url}
+        if self.secret_token:
+            data['secret_token'] = self.secret_token
+        return request.post('{}/setWebhook'.format(self.bot.base_url), data)
+
+    def _bootstrap(self, max_retries, clean, webhook_url, cert=None):
+        retries = 0
+        while True:
+            try:
+                if clean:
+                    self.bot.setWebhook(webhook_url='')
+                    self._clean_updates()
+                self.set_webhook(webhook_url)
+            except (Unauthorized, InvalidToken):
+                raise
+            except TelegramError:
+                if max_retries < 0 or retries < max_retries:
+                    self.logger.warning("Couldn't set the webhook, try {} of {}".format(
+                        retries, max_retries))
+                    retries += 1
+                else:
+                    raise
+            else:
+                return
+            sleep(1)